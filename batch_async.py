@@ -0,0 +1,555 @@
+#!/usr/bin/env python3
+"""asyncio engine for batch_detect: many in-flight requests without one OS thread per request."""
+
+import argparse
+import asyncio
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    import aiohttp
+except ImportError as exc:  # pragma: no cover - optional dependency
+    raise ImportError(
+        "The asyncio engine requires aiohttp. Install it with `python -m pip install aiohttp`."
+    ) from exc
+
+from batch_common import (
+    TokenEscalation,
+    TokenLadder,
+    build_cached_record,
+    build_detection_record,
+    build_failure_entry,
+    build_failure_record,
+    prepare_request,
+    queue_completion,
+    request_seconds,
+    total_tokens,
+)
+from batch_control import (
+    AdaptiveConcurrency,
+    Endpoint,
+    EndpointBalancer,
+    HedgePolicy,
+    RetryPolicy,
+    RunProgress,
+    describe_attempt,
+    is_retryable_error,
+)
+from record_writer import RecordWriter
+from response_cache import ResponseCache
+from work_queue import WorkQueue
+from query_bbox import (
+    CompletionStreamAccumulator,
+    HEALTH_PROBE_TIMEOUT,
+    DetectionError,
+    parse_completion_response,
+    warn,
+)
+
+
+async def request_completion_async(
+    session: "aiohttp.ClientSession",
+    api_base: str,
+    body: bytes,
+    timeout: float,
+    stream: bool = False,
+    stop_at_array_end: bool = False,
+) -> Dict[str, Any]:
+    """POST a pre-serialized payload; with ``stream`` the body must request SSE output."""
+    url = f"{api_base.rstrip('/')}/chat/completions"
+    if stream:
+        client_timeout = aiohttp.ClientTimeout(sock_read=timeout)
+    else:
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+    accumulator = CompletionStreamAccumulator(time.perf_counter(), stop_at_array_end)
+    try:
+        async with session.post(
+            url,
+            data=body,
+            headers={"Content-Type": "application/json"},
+            timeout=client_timeout,
+        ) as response:
+            status = response.status
+            if not stream or status >= 400:
+                text = await response.text()
+                return parse_completion_response(status, text)
+            async for raw_line in response.content:
+                line = raw_line.decode("utf-8").strip()
+                if line and accumulator.feed_line(line):
+                    break
+            return accumulator.result()
+    except asyncio.TimeoutError as exc:
+        raise DetectionError(
+            f"Request to {url} timed out after {timeout:.0f} seconds. "
+            "Increase --timeout or check server load.",
+            kind="timeout",
+        ) from exc
+    except aiohttp.ClientError as exc:
+        raise DetectionError(
+            f"Failed to reach the model endpoint: {exc}", kind="transport"
+        ) from exc
+
+
+async def acquire_endpoint(
+    balancer: EndpointBalancer, avoid: Optional[Endpoint] = None
+) -> Endpoint:
+    while True:
+        if balancer.stopping.is_set():
+            raise DetectionError("Stopped while waiting for an endpoint.", kind="cancelled")
+        endpoint = balancer.try_acquire(avoid)
+        if endpoint is not None:
+            return endpoint
+        await asyncio.sleep(0.05)
+
+
+async def wait_for_stop(balancer: EndpointBalancer, delay: float) -> bool:
+    """Sleep ``delay`` seconds unless the balancer is stopped first; True if it was."""
+    deadline = time.perf_counter() + delay
+    while not balancer.stopping.is_set():
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return False
+        await asyncio.sleep(min(remaining, 0.05))
+    return True
+
+
+async def run_attempt_async(
+    session: "aiohttp.ClientSession",
+    balancer: EndpointBalancer,
+    endpoint: Endpoint,
+    body: bytes,
+    timeout: float,
+    controller: Optional[AdaptiveConcurrency] = None,
+    stream: bool = False,
+    stop_at_array_end: bool = False,
+) -> Dict[str, Any]:
+    start_time = time.perf_counter()
+    try:
+        response = await request_completion_async(
+            session, endpoint.api_base, body, timeout, stream, stop_at_array_end
+        )
+    except DetectionError as exc:
+        elapsed = time.perf_counter() - start_time
+        exc.endpoint = endpoint.api_base
+        balancer.release(endpoint, elapsed, exc)
+        if controller is not None:
+            controller.record(start_time, elapsed, exc)
+        raise
+    except asyncio.CancelledError:
+        balancer.release(
+            endpoint,
+            time.perf_counter() - start_time,
+            DetectionError("Request cancelled.", kind="cancelled"),
+        )
+        raise
+    elapsed = time.perf_counter() - start_time
+    balancer.release(endpoint, elapsed)
+    if controller is not None:
+        controller.record(start_time, elapsed)
+    return response
+
+
+async def run_hedged_attempt_async(
+    session: "aiohttp.ClientSession",
+    balancer: EndpointBalancer,
+    hedge_policy: HedgePolicy,
+    body: bytes,
+    timeout: float,
+    controller: Optional[AdaptiveConcurrency] = None,
+    stream: bool = False,
+    stop_at_array_end: bool = False,
+) -> Tuple[Dict[str, Any], str, Dict[str, Any]]:
+    """asyncio counterpart of ``batch_detect.run_hedged_attempt``; the loser task is cancelled."""
+    primary_endpoint = await acquire_endpoint(balancer)
+    primary_started = time.perf_counter()
+    copies: Dict["asyncio.Task[Dict[str, Any]]", Tuple[str, str]] = {}
+    primary = asyncio.ensure_future(
+        run_attempt_async(
+            session,
+            balancer,
+            primary_endpoint,
+            body,
+            timeout,
+            controller,
+            stream,
+            stop_at_array_end,
+        )
+    )
+    copies[primary] = ("primary", primary_endpoint.api_base)
+
+    delay = hedge_policy.hedge_delay()
+    if delay is not None:
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if not done and hedge_policy.try_acquire():
+            try:
+                hedge_endpoint = await acquire_endpoint(balancer, avoid=primary_endpoint)
+            except DetectionError:
+                hedge_policy.release()
+            else:
+                hedge = asyncio.ensure_future(
+                    run_attempt_async(
+                        session,
+                        balancer,
+                        hedge_endpoint,
+                        body,
+                        timeout,
+                        controller,
+                        stream,
+                        stop_at_array_end,
+                    )
+                )
+                copies[hedge] = ("hedge", hedge_endpoint.api_base)
+
+    last_error: Optional[DetectionError] = None
+    pending = set(copies)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                role, api_base = copies[task]
+                try:
+                    response = task.result()
+                except DetectionError as exc:
+                    last_error = exc
+                    continue
+                hedge_policy.record_latency(time.perf_counter() - primary_started)
+                hedge_policy.record_win(role == "hedge")
+                return response, api_base, {"hedged": len(copies) > 1, "winner": role}
+    finally:
+        for task in pending:
+            task.cancel()
+    assert last_error is not None
+    raise last_error
+
+
+async def request_with_retries_async(
+    session: "aiohttp.ClientSession",
+    balancer: EndpointBalancer,
+    body: bytes,
+    timeout: float,
+    retry_policy: Optional[RetryPolicy] = None,
+    controller: Optional[AdaptiveConcurrency] = None,
+    stream: bool = False,
+    stop_at_array_end: bool = False,
+    hedge_policy: Optional[HedgePolicy] = None,
+) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """asyncio counterpart of ``batch_detect.request_with_retries``."""
+    attempts: List[Dict[str, Any]] = []
+    if retry_policy is not None:
+        retry_policy.register_request()
+    if hedge_policy is not None:
+        hedge_policy.register_request()
+    while True:
+        start_time = time.perf_counter()
+        hedge_details: Dict[str, Any] = {}
+        try:
+            if hedge_policy is not None:
+                response, api_base, hedge_details = await run_hedged_attempt_async(
+                    session,
+                    balancer,
+                    hedge_policy,
+                    body,
+                    timeout,
+                    controller,
+                    stream,
+                    stop_at_array_end,
+                )
+            else:
+                endpoint = await acquire_endpoint(balancer)
+                response = await run_attempt_async(
+                    session,
+                    balancer,
+                    endpoint,
+                    body,
+                    timeout,
+                    controller,
+                    stream,
+                    stop_at_array_end,
+                )
+                api_base = endpoint.api_base
+        except DetectionError as exc:
+            elapsed = time.perf_counter() - start_time
+            outcome = describe_attempt(len(attempts) + 1, elapsed, exc, exc.endpoint)
+            attempts.append(outcome)
+            requeues = sum(1 for attempt in attempts if attempt.get("requeued"))
+            if (
+                is_retryable_error(exc)
+                and retry_policy is not None
+                and requeues < retry_policy.max_requeues
+                and balancer.breaker_open(exc.endpoint)
+            ):
+                # The endpoint's breaker opened; requeue without spending a retry.
+                outcome["requeued"] = True
+                continue
+            counted = sum(1 for attempt in attempts if not attempt.get("requeued"))
+            delay = retry_policy.next_delay(counted, exc) if retry_policy else None
+            if delay is None:
+                exc.attempts = attempts
+                raise
+            outcome["backoff_seconds"] = round(delay, 3)
+            if await wait_for_stop(balancer, delay):
+                stopped = DetectionError("Stopped while backing off for a retry.", kind="cancelled")
+                stopped.attempts = attempts
+                raise stopped from exc
+            continue
+        elapsed = time.perf_counter() - start_time
+        outcome = describe_attempt(len(attempts) + 1, elapsed, endpoint=api_base)
+        outcome.update(hedge_details)
+        attempts.append(outcome)
+        return response, attempts
+
+
+async def probe_endpoint_async(session: "aiohttp.ClientSession", api_base: str) -> bool:
+    """Return True when ``GET {api_base}/models`` answers successfully."""
+    url = f"{api_base.rstrip('/')}/models"
+    try:
+        async with session.get(
+            url, timeout=aiohttp.ClientTimeout(total=HEALTH_PROBE_TIMEOUT)
+        ) as response:
+            return response.status < 400
+    except (asyncio.TimeoutError, aiohttp.ClientError):
+        return False
+
+
+async def run_health_prober_async(
+    session: "aiohttp.ClientSession", balancer: EndpointBalancer
+) -> None:
+    """Probe endpoints with an open circuit breaker until cancelled."""
+    while True:
+        await asyncio.sleep(0.5)
+        for endpoint in balancer.due_probes():
+            healthy = await probe_endpoint_async(session, endpoint.api_base)
+            balancer.probe_result(endpoint, healthy)
+
+
+async def run_async_batch(
+    args: argparse.Namespace,
+    images: Iterable[Path],
+    processed_paths: Set[str],
+    writer: RecordWriter,
+    balancer: EndpointBalancer,
+    ladder: TokenLadder,
+    progress: RunProgress,
+    controller: Optional[AdaptiveConcurrency] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+    hedge_policy: Optional[HedgePolicy] = None,
+    cache: Optional[ResponseCache] = None,
+    work_queue: Optional[WorkQueue] = None,
+) -> None:
+    """Process ``images`` with at most ``--max-workers`` requests in flight on one event loop.
+
+    ``images`` is consumed on a feeder thread, since a directory scan or work-queue claim
+    may block. Request bodies are rendered from ``ladder``'s templates on
+    ``--prepare-workers`` threads, up to ``--prefetch`` ahead of a free request slot, and
+    results are queued to ``writer``'s thread, so the loop itself only multiplexes
+    sockets. Cache hits never take a request slot. The first SIGINT/SIGTERM stops
+    dispatching and lets in-flight requests finish; a second one cancels them. Cancelled
+    images are not written and are picked up again by ``--resume``. Dispatch also stops
+    once ``progress`` no longer admits requests before its deadline. With a ``controller``
+    the semaphore is only the ceiling and dispatch also waits for its current limit.
+    """
+    loop = asyncio.get_running_loop()
+    dataset_root = args.dataset_root
+    in_flight = asyncio.Semaphore(args.max_workers)
+    stop_event = asyncio.Event()
+    tasks: Set["asyncio.Task[None]"] = set()
+    prefetch = args.prefetch if args.prefetch is not None else 2 * args.max_workers
+    # Requests being prepared ahead of a free request slot, in dataset order.
+    ready: "asyncio.Queue[Optional[Tuple[str, TokenEscalation, asyncio.Future[Any]]]]" = (
+        asyncio.Queue(maxsize=prefetch)
+    )
+    feeder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="feed")
+    cache_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-writer")
+    preparer = ThreadPoolExecutor(max_workers=args.prepare_workers, thread_name_prefix="prepare")
+
+    def request_stop(signum: int) -> None:  # pragma: no cover - system integration
+        if stop_event.is_set():
+            warn(f"Received signal {signum} again; cancelling {len(tasks)} in-flight requests.")
+            for task in tasks:
+                task.cancel()
+            return
+        stop_event.set()
+        progress.stop("signal")
+        balancer.stop()
+        warn(f"Received signal {signum}; finishing in-progress tasks gracefully...")
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, request_stop, signum)
+
+    def write_records(
+        image_key: str, detections: List[Dict[str, Any]], generation_record: Dict[str, Any]
+    ) -> None:
+        writer.write_details(generation_record)
+        writer.write_result(
+            {"image": image_key, "detections": detections},
+            on_written=queue_completion(work_queue, image_key),
+        )
+        processed_paths.add(image_key)
+        progress.record(
+            request_seconds(generation_record.get("attempts")),
+            total_tokens(generation_record.get("response")),
+        )
+        print(f"Processed {image_key} ({len(detections)} detections) [{progress.status()}]")
+
+    def record_failure(rel_path: str, exc: Exception) -> None:
+        if isinstance(exc, DetectionError):
+            if exc.kind == "cancelled":
+                warn(f"Stopped before {rel_path} finished; --resume will send it again.")
+                return
+            warn(f"Detection error for {rel_path}: {exc}")
+            progress.record(request_seconds(exc.attempts), failed=True)
+            writer.write_details(build_failure_record(rel_path, exc))
+        else:
+            warn(f"Unexpected error for {rel_path}: {exc}")
+            progress.record(failed=True)
+        writer.write_failure(build_failure_entry(rel_path, exc))
+        if work_queue is not None:
+            loop.run_in_executor(None, work_queue.fail, rel_path, str(exc))
+
+    async def feed() -> None:
+        """Pull images on the feeder thread and start preparing each one.
+
+        Ends the ``ready`` queue with None, also when reading the images fails.
+        """
+        iterator = iter(images)
+        try:
+            while True:
+                image_path = await loop.run_in_executor(feeder, next, iterator, None)
+                if image_path is None:
+                    break
+                rel_path = image_path.relative_to(dataset_root).as_posix()
+                if rel_path in processed_paths:
+                    continue
+                escalation = ladder.start(image_path, args.image_transport)
+                prepared = loop.run_in_executor(preparer, prepare_request, escalation, cache)
+                await ready.put((rel_path, escalation, prepared))
+        except Exception:
+            await ready.put(None)
+            raise
+        await ready.put(None)
+
+    async def next_ready() -> Optional[Tuple[str, TokenEscalation, "asyncio.Future[Any]"]]:
+        """The next prepared request, or None at the end of the images or on a stop."""
+        if not ready.empty():
+            return ready.get_nowait()
+        getter = loop.create_task(ready.get())
+        stopper = loop.create_task(stop_event.wait())
+        await asyncio.wait({getter, stopper}, return_when=asyncio.FIRST_COMPLETED)
+        stopper.cancel()
+        if getter.done():
+            return getter.result()
+        getter.cancel()
+        return None
+
+    async def process(
+        session: "aiohttp.ClientSession",
+        rel_path: str,
+        escalation: TokenEscalation,
+        body: bytearray,
+    ) -> None:
+        try:
+            attempts: List[Dict[str, Any]] = []
+            while True:
+                response, tries = await request_with_retries_async(
+                    session,
+                    balancer,
+                    body,
+                    args.timeout,
+                    retry_policy,
+                    controller,
+                    stream=args.stream or args.stream_early_stop,
+                    stop_at_array_end=args.stream_early_stop,
+                    hedge_policy=hedge_policy,
+                )
+                attempts.extend(tries)
+                try:
+                    image_key, detections, generation_record = build_detection_record(
+                        rel_path, response, attempts[-1]["elapsed_seconds"]
+                    )
+                    break
+                except DetectionError as exc:
+                    escalated = await loop.run_in_executor(preparer, escalation.escalate, exc)
+                    if escalated is None:
+                        exc.attempts = attempts
+                        exc.token_budget = escalation.summary()
+                        raise
+                    body = escalated
+            generation_record["attempts"] = attempts
+            escalation.finish(response)
+            if escalation.summary() is not None:
+                generation_record["token_budget"] = escalation.summary()
+            if cache is not None:
+                await loop.run_in_executor(cache_writer, escalation.store, cache, response)
+            write_records(image_key, detections, generation_record)
+        except asyncio.CancelledError:
+            warn(f"Cancelled in-flight request for {rel_path}")
+            raise
+        except Exception as exc:
+            record_failure(rel_path, exc)
+        finally:
+            in_flight.release()
+
+    pool_size = args.pool_size or args.max_workers
+    if hedge_policy is not None:
+        # Each request may have a primary and a hedged copy in flight at once; a hedge
+        # queued behind a full pool could not cut the tail.
+        pool_size *= 2
+    connector = aiohttp.TCPConnector(limit=pool_size)
+    feeder_task = loop.create_task(feed())
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            prober = loop.create_task(run_health_prober_async(session, balancer))
+            while True:
+                item = await next_ready()
+                if item is None:
+                    break
+                rel_path, escalation, prepared = item
+                # Wait for preparation before taking a request slot.
+                await asyncio.wait([prepared])
+                if stop_event.is_set():
+                    break
+                try:
+                    body, cached = prepared.result()
+                    if cached is not None:
+                        write_records(*build_cached_record(rel_path, cached))
+                        continue
+                except Exception as exc:
+                    record_failure(rel_path, exc)
+                    continue
+                await in_flight.acquire()
+                while controller is not None and tasks and len(tasks) >= controller.limit:
+                    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                if stop_event.is_set():
+                    in_flight.release()
+                    break
+                if not progress.admits():
+                    in_flight.release()
+                    stop_event.set()
+                    warn("Deadline reached for new requests; finishing in-progress tasks...")
+                    break
+                task = loop.create_task(process(session, rel_path, escalation, body))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if stop_event.is_set():
+                feeder_task.cancel()
+                if progress.stop_reason == "signal":
+                    warn("Stopping submission of new tasks due to signal.")
+
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            prober.cancel()
+            if stop_event.is_set():
+                warn(f"All in-flight tasks completed after {progress.stop_reason} stop.")
+            else:
+                # Re-raises a failure to read the images.
+                await feeder_task
+    finally:
+        feeder_task.cancel()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
+        feeder.shutdown(wait=True)
+        preparer.shutdown(wait=True)
+        cache_writer.shutdown(wait=True)
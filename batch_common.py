@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""Request, record and run-bookkeeping helpers shared by the batch_detect engines."""
+
+import hashlib
+import json
+import shlex
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from batch_control import RunProgress, TokenBudgetPolicy, format_duration
+from query_bbox import (
+    DetectionError,
+    PayloadTemplate,
+    extract_detections,
+    format_debug_info,
+    sanitize_detections,
+    warn,
+)
+from response_cache import CacheKeyTemplate, ResponseCache
+from work_queue import WorkQueue
+
+
+def write_arguments_file(path: Path, payload: Dict[str, Any]) -> None:
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("w", encoding="utf-8") as handle:
+            json.dump(payload, handle, ensure_ascii=False, indent=2)
+    except OSError as exc:
+        warn(f"Failed to write arguments file to {path}: {exc}")
+
+
+class TokenLadder:
+    """One ``PayloadTemplate`` (and cache-key template) per ``max_tokens`` budget.
+
+    Without a ``policy`` the ladder has the single ``--max-tokens`` rung and never escalates.
+    """
+
+    def __init__(
+        self,
+        build: Callable[[int], PayloadTemplate],
+        max_tokens: int,
+        policy: Optional[TokenBudgetPolicy] = None,
+        cache_enabled: bool = False,
+    ) -> None:
+        self.policy = policy
+        rungs = policy.rungs if policy is not None else [max_tokens]
+        self.templates = {rung: build(rung) for rung in rungs}
+        self.cache_keys = (
+            {rung: CacheKeyTemplate(template) for rung, template in self.templates.items()}
+            if cache_enabled
+            else {}
+        )
+
+    def start(self, image_path: Path, image_transport: str) -> "TokenEscalation":
+        budget = self.policy.initial_budget() if self.policy is not None else next(
+            iter(self.templates)
+        )
+        return TokenEscalation(self, image_path, image_transport, budget)
+
+
+class TokenEscalation:
+    """One image's way up the ``TokenLadder`` after length-truncated generations."""
+
+    def __init__(
+        self, ladder: TokenLadder, image_path: Path, image_transport: str, budget: int
+    ) -> None:
+        self.ladder = ladder
+        self.image_path = image_path
+        self.image_transport = image_transport
+        self.initial = budget
+        self.budget = budget
+        self.truncated: List[Dict[str, Any]] = []
+        # Set by ``prepare_request`` when caching; the image is the same on every rung.
+        self.image_sha256: Optional[str] = None
+
+    @property
+    def template(self) -> PayloadTemplate:
+        return self.ladder.templates[self.budget]
+
+    def cache_key(self) -> Optional[str]:
+        """Cache key of the request at the current budget."""
+        keys = self.ladder.cache_keys.get(self.budget)
+        if keys is None or self.image_sha256 is None:
+            return None
+        return keys.key(self.image_sha256)
+
+    def store(self, cache: Optional[ResponseCache], body: Dict[str, Any]) -> None:
+        """Cache ``body`` under the budget that produced it, not the one first tried."""
+        key = self.cache_key()
+        if cache is not None and key is not None:
+            cache.put(key, body)
+
+    def lookup_keys(self) -> List[str]:
+        """Cache keys a response for this image may be stored under: this budget or higher.
+
+        A completion generated with more room than requested still answers the request.
+        """
+        if self.image_sha256 is None:
+            return []
+        return [
+            keys.key(self.image_sha256)
+            for rung, keys in sorted(self.ladder.cache_keys.items())
+            if rung >= self.budget
+        ]
+
+    def escalate(self, error: DetectionError) -> Optional[bytearray]:
+        """Request body at the next budget if ``error`` is a truncation below the ceiling."""
+        policy = self.ladder.policy
+        if policy is None or error.kind != "length":
+            return None
+        response = (error.generation_details or {}).get("response")
+        self.truncated.append(
+            {"max_tokens": self.budget, "completion_tokens": completion_tokens(response)}
+        )
+        higher = policy.next_budget(self.budget)
+        if higher is None:
+            return None
+        self.budget = higher
+        return self.template.render(self.image_path, self.image_transport)
+
+    def finish(self, body: Dict[str, Any]) -> None:
+        """Feed the final completion length back into the policy."""
+        policy = self.ladder.policy
+        if policy is None:
+            return
+        tokens = completion_tokens(body)
+        if tokens is not None:
+            policy.record_completion(tokens)
+        if self.truncated:
+            policy.record_rescue()
+
+    def summary(self) -> Optional[Dict[str, Any]]:
+        if self.ladder.policy is None:
+            return None
+        return {"initial": self.initial, "final": self.budget, "truncated": self.truncated}
+
+
+def completion_tokens(body: Any) -> Optional[int]:
+    usage = body.get("usage") if isinstance(body, dict) else None
+    tokens = usage.get("completion_tokens") if isinstance(usage, dict) else None
+    return tokens if isinstance(tokens, int) else None
+
+
+def total_tokens(body: Any) -> Optional[int]:
+    usage = body.get("usage") if isinstance(body, dict) else None
+    tokens = usage.get("total_tokens") if isinstance(usage, dict) else None
+    return tokens if isinstance(tokens, int) else None
+
+
+def request_seconds(attempts: Optional[Sequence[Dict[str, Any]]]) -> Optional[float]:
+    """Time an image spent on requests and retry backoff, or None if it sent none."""
+    if not attempts:
+        return None
+    return sum(
+        attempt.get("elapsed_seconds", 0.0) + attempt.get("backoff_seconds", 0.0)
+        for attempt in attempts
+    )
+
+
+def render_request(
+    template: PayloadTemplate,
+    image_path: Path,
+    image_transport: str = "base64",
+    hash_image: bool = False,
+) -> Tuple[bytearray, Optional[str]]:
+    """Return the request body for ``image_path`` and, with ``hash_image``, the SHA-256 of
+    the image bytes it carries (the input to the cache keys)."""
+    digest = hashlib.sha256() if hash_image else None
+    body = template.render(image_path, image_transport, digest)
+    return body, digest.hexdigest() if digest is not None else None
+
+
+def prepare_request(
+    escalation: TokenEscalation, cache: Optional[ResponseCache] = None
+) -> Tuple[bytearray, Optional[Dict[str, Any]]]:
+    """Prepare stage: render the body at the escalation's budget and look up the cache.
+
+    Returns the body and the cached response on a hit.
+    """
+    caching = cache is not None and bool(escalation.ladder.cache_keys)
+    body, escalation.image_sha256 = render_request(
+        escalation.template, escalation.image_path, escalation.image_transport, caching
+    )
+    cached = cache.get_first(escalation.lookup_keys()) if cache is not None and caching else None
+    return body, cached
+
+
+def build_detection_record(
+    rel_path: str, body: Dict[str, Any], elapsed: float
+) -> Tuple[str, List[Dict[str, Any]], Dict[str, Any]]:
+    detections, raw_text, raw_body, metadata = extract_detections(body)
+    detections = list(detections)
+    sanitized = sanitize_detections(detections)
+    if detections and not sanitized:
+        raise DetectionError(
+            f"Image '{rel_path}' produced detections but none were usable."
+            + format_debug_info(raw_text, raw_body)
+        )
+    detections_to_use = sanitized if sanitized else detections
+    cot_text = metadata.get("cot_output") if isinstance(metadata, dict) else None
+    finish_reason = metadata.get("finish_reason") if isinstance(metadata, dict) else None
+    generation_record = {
+        "image": rel_path,
+        "elapsed_seconds": elapsed,
+        "assistant_text": raw_text,
+        "cot_text": cot_text,
+        "finish_reason": finish_reason,
+        "detections": detections_to_use,
+        "response": body,
+    }
+    return rel_path, detections_to_use, generation_record
+
+
+def build_cached_record(
+    rel_path: str, body: Dict[str, Any]
+) -> Tuple[str, List[Dict[str, Any]], Dict[str, Any]]:
+    rel_path, detections, generation_record = build_detection_record(rel_path, body, 0.0)
+    generation_record["cache"] = "hit"
+    return rel_path, detections, generation_record
+
+
+def build_failure_entry(rel_path: str, error: Exception) -> Dict[str, Any]:
+    """Compact failure-ledger line: what failed, how, and after how much effort."""
+    attempts = error.attempts if isinstance(error, DetectionError) else []
+    details = error.generation_details if isinstance(error, DetectionError) else None
+    response = details.get("response") if details else None
+    finish_reason = None
+    if isinstance(response, dict) and response.get("choices"):
+        choice = response["choices"][0]
+        finish_reason = choice.get("finish_reason") if isinstance(choice, dict) else None
+    message = str(error).strip()
+    return {
+        "image": rel_path,
+        "error_kind": error.kind if isinstance(error, DetectionError) else "unexpected",
+        "error": message.splitlines()[0] if message else type(error).__name__,
+        "attempts": len(attempts),
+        "finish_reason": finish_reason,
+        "elapsed_seconds": round(sum(item.get("elapsed_seconds", 0.0) for item in attempts), 3),
+        "failed_at": time.time(),
+    }
+
+
+def build_failure_record(rel_path: str, error: DetectionError) -> Dict[str, Any]:
+    record: Dict[str, Any] = {
+        "image": rel_path,
+        "error": str(error),
+        "error_kind": error.kind,
+        "attempts": error.attempts,
+    }
+    if error.token_budget is not None:
+        record["token_budget"] = error.token_budget
+    details = error.generation_details
+    if details:
+        record.update(
+            {
+                "assistant_text": details.get("assistant_text"),
+                "cot_text": details.get("cot_text"),
+                "response": details.get("response"),
+            }
+        )
+    return record
+
+
+def queue_completion(
+    work_queue: Optional[WorkQueue], rel_path: str
+) -> Optional[Callable[[], Any]]:
+    """Callback marking ``rel_path`` done in ``work_queue`` once its result is written."""
+    if work_queue is None:
+        return None
+    return lambda: work_queue.complete(rel_path)
+
+
+class PendingImages:
+    """The images a run still has to send, counted as an engine consumes them.
+
+    Paths already in ``processed_paths`` are skipped. Once the source runs out,
+    ``progress.total`` becomes exact; ``remaining`` tells a stopped run how many images it
+    left, finishing the scan (without opening any image) to count the rest.
+    """
+
+    def __init__(
+        self,
+        images: Iterable[Path],
+        dataset_root: Path,
+        processed_paths: Set[str],
+        progress: RunProgress,
+    ) -> None:
+        self.dataset_root = dataset_root
+        self.processed_paths = processed_paths
+        self.progress = progress
+        self.yielded = 0
+        self._iterator = self._generate(images)
+
+    def __iter__(self) -> Iterator[Path]:
+        return self._iterator
+
+    def remaining(self) -> int:
+        for _ in self._iterator:
+            pass
+        return max(self.yielded - self.progress.done, 0)
+
+    def _generate(self, images: Iterable[Path]) -> Iterator[Path]:
+        for path in images:
+            if path.relative_to(self.dataset_root).as_posix() in self.processed_paths:
+                continue
+            self.yielded += 1
+            yield path
+        self.progress.total = self.yielded
+
+
+# Flags whose value is tied to the run that set them; a resumed run must choose its own.
+_RUN_BOUND_FLAGS = ("--deadline", "--time-budget")
+
+
+def resume_argv(argv: Sequence[str]) -> List[str]:
+    """Command line that resumes the run started with ``argv``.
+
+    ``--deadline`` and ``--time-budget`` are dropped: an absolute deadline is now in the
+    past, and a budget would silently be spent again.
+    """
+    resumed = ["python"]
+    skip_value = False
+    for arg in argv:
+        if skip_value:
+            skip_value = False
+        elif arg in _RUN_BOUND_FLAGS:
+            skip_value = True
+        elif not arg.startswith(tuple(f"{flag}=" for flag in _RUN_BOUND_FLAGS)):
+            resumed.append(arg)
+    if "--resume" not in resumed:
+        resumed.append("--resume")
+    return resumed
+
+
+def report_early_stop(
+    path: Path,
+    progress: RunProgress,
+    pending_images: PendingImages,
+    processed_paths: Set[str],
+    open_failures: int,
+    work_queue: Optional[WorkQueue] = None,
+) -> None:
+    """Record why a run stopped early and what a ``--resume`` run still has to do.
+
+    A run that was not stopped early removes a summary left by an earlier stop.
+    """
+    if progress.stop_reason is None:
+        if path.exists():
+            path.unlink()
+        return
+    if work_queue is not None:
+        # Claiming the rest to count it would lease it away from other workers.
+        stats = work_queue.summary()
+        remaining = stats["pending"] + stats["leased"]
+    else:
+        remaining = pending_images.remaining()
+    argv = resume_argv(sys.argv)
+    eta = progress.eta_seconds(remaining)
+    payload = {
+        "stopped_at": datetime.now().isoformat(timespec="seconds"),
+        "reason": progress.stop_reason,
+        "deadline": datetime.fromtimestamp(progress.deadline).isoformat(timespec="seconds")
+        if progress.deadline is not None
+        else None,
+        "processed_images": len(processed_paths),
+        "remaining_images": remaining,
+        "open_failures": open_failures,
+        "estimated_seconds_to_finish": eta,
+        "this_run": progress.summary(),
+        "resume_command": shlex.join(argv),
+    }
+    write_arguments_file(path, payload)
+    print(
+        f"Stopped on {progress.stop_reason}: {remaining} images remain"
+        + (f" (about {format_duration(eta)} at the current rate)" if eta is not None else "")
+        + f", {open_failures} failures are open. Summary written to {path}; "
+        "rerun with --resume to continue."
+    )
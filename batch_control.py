@@ -0,0 +1,822 @@
+#!/usr/bin/env python3
+"""Client-side flow control shared by the batch_detect engines."""
+
+import json
+import math
+import random
+import time
+from collections import deque
+from pathlib import Path
+from threading import Condition, Event, Lock
+from typing import Any, Deque, Dict, List, Optional, Sequence, Tuple
+
+from PIL import Image
+
+from query_bbox import DetectionError, warn
+
+OVERLOAD_STATUS_CODES = {429, 503}
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429}
+
+
+def percentile(values: Any, fraction: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(math.ceil(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def is_overload_error(error: DetectionError) -> bool:
+    return error.kind == "timeout" or error.status_code in OVERLOAD_STATUS_CODES
+
+
+def is_retryable_error(error: DetectionError) -> bool:
+    """Transport failures, timeouts, 429 and 5xx are transient; bad model output is not."""
+    if error.kind in ("timeout", "transport"):
+        return True
+    if error.kind == "http" and error.status_code is not None:
+        return error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+    return False
+
+
+def describe_attempt(
+    attempt: int,
+    elapsed: float,
+    error: Optional[DetectionError] = None,
+    endpoint: Optional[str] = None,
+) -> Dict[str, Any]:
+    outcome: Dict[str, Any] = {
+        "attempt": attempt,
+        "elapsed_seconds": round(elapsed, 3),
+        "outcome": "ok" if error is None else "error",
+    }
+    if endpoint is not None:
+        outcome["endpoint"] = endpoint
+    if error is not None:
+        outcome["error_kind"] = error.kind
+        if error.status_code is not None:
+            outcome["status_code"] = error.status_code
+        outcome["error"] = str(error)[:300]
+    return outcome
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, capped by a retry budget shared across a run.
+
+    Retries are only granted while the total number of retries stays below
+    ``budget_floor + budget_ratio * first_attempts``, so a failing server sees at most a
+    bounded fraction of extra load instead of every worker retrying in lockstep.
+
+    A request whose endpoint's circuit breaker opened is re-queued to another endpoint
+    without spending a retry, at most ``max_requeues`` times; after that its failures count
+    as ordinary retries.
+    """
+
+    def __init__(
+        self,
+        max_retries: int,
+        base_delay: float,
+        max_delay: float,
+        budget_ratio: float,
+        budget_floor: int = 10,
+        max_requeues: int = 5,
+    ) -> None:
+        self.max_retries = max(0, max_retries)
+        self.max_requeues = max(0, max_requeues)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget_floor = budget_floor
+        self.first_attempts = 0
+        self.retries = 0
+        self._budget_warned = False
+        self._lock = Lock()
+
+    def register_request(self) -> None:
+        with self._lock:
+            self.first_attempts += 1
+
+    def next_delay(self, attempt: int, error: DetectionError) -> Optional[float]:
+        """Return how long to sleep before retrying after ``attempt`` failed, or None to give up."""
+        if attempt > self.max_retries or not is_retryable_error(error):
+            return None
+        with self._lock:
+            budget = self.budget_floor + self.budget_ratio * self.first_attempts
+            if self.retries >= budget:
+                if not self._budget_warned:
+                    self._budget_warned = True
+                    warn(
+                        f"Retry budget exhausted ({self.retries} retries for "
+                        f"{self.first_attempts} requests); failing fast until it recovers."
+                    )
+                return None
+            self.retries += 1
+            self._budget_warned = False
+        return random.uniform(0.0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class AdaptiveConcurrency:
+    """AIMD controller for the number of requests kept in flight.
+
+    The limit doubles per round trip (slow start) until the first congestion signal, then
+    grows by one per round trip while the windowed p95 latency and transport error rate
+    stay within target. Timeouts, HTTP 429/503 and p95 latency above target cut the limit
+    by ``decrease_factor``; at most one cut is applied per round trip, i.e. requests that
+    were already in flight when the limit was cut do not cut it again.
+    """
+
+    def __init__(
+        self,
+        minimum: int,
+        maximum: int,
+        target_p95: float,
+        max_error_rate: float,
+        window: int = 50,
+        decrease_factor: float = 0.5,
+        log_path: Optional[Path] = None,
+    ) -> None:
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.target_p95 = target_p95
+        self.max_error_rate = max_error_rate
+        self.decrease_factor = decrease_factor
+        self.log_path = log_path
+        self._limit = float(self.minimum)
+        self._slow_start = True
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._errors: Deque[bool] = deque(maxlen=window)
+        self._started_at = time.perf_counter()
+        self._last_decrease_at = self._started_at
+        self._lock = Lock()
+        # Direction of the last change printed; steps the same way only go to the log.
+        self._printed_direction: Optional[str] = None
+        self._log_event("start")
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def record(
+        self, request_started_at: float, latency: float, error: Optional[DetectionError] = None
+    ) -> None:
+        """Feed one finished request (``error`` is the failure, if any) into the controller."""
+        overloaded = error is not None and is_overload_error(error)
+        transport_error = error is not None and error.kind in ("timeout", "transport", "http")
+        with self._lock:
+            previous = self.limit
+            self._errors.append(transport_error)
+            if not transport_error:
+                self._latencies.append(latency)
+            p95, error_rate = self._window_stats()
+            spike = (
+                len(self._latencies) >= 10 and p95 > self.target_p95 and latency > self.target_p95
+            )
+
+            if overloaded or spike:
+                if request_started_at >= self._last_decrease_at:
+                    self._slow_start = False
+                    self._limit = max(
+                        float(self.minimum), math.floor(self._limit * self.decrease_factor)
+                    )
+                    self._last_decrease_at = time.perf_counter()
+                    self._latencies.clear()
+                    reason = "overload" if overloaded else "latency"
+                    self._log_change(previous, reason, p95, error_rate)
+                return
+
+            if transport_error or error_rate > self.max_error_rate:
+                return
+
+            if self._slow_start:
+                self._limit = min(float(self.maximum), self._limit + 1.0)
+            else:
+                self._limit = min(float(self.maximum), self._limit + 1.0 / self._limit)
+            if self.limit != previous:
+                self._log_change(previous, "increase", p95, error_rate)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            p95, error_rate = self._window_stats()
+            return {"limit": self.limit, "p95_seconds": p95, "error_rate": error_rate}
+
+    def _window_stats(self) -> Tuple[float, float]:
+        p95 = percentile(self._latencies, 0.95)
+        error_rate = sum(self._errors) / len(self._errors) if self._errors else 0.0
+        return p95, error_rate
+
+    def _log_change(self, previous: int, reason: str, p95: float, error_rate: float) -> None:
+        direction = "up" if reason == "increase" else "down"
+        if direction != self._printed_direction:
+            self._printed_direction = direction
+            print(
+                f"Concurrency {previous} -> {self.limit} ({reason}; "
+                f"p95 {p95:.1f}s, error rate {error_rate:.0%})"
+            )
+        self._log_event(reason, p95=round(p95, 3), error_rate=round(error_rate, 3))
+
+    def _log_event(self, event: str, **fields: Any) -> None:
+        if self.log_path is None:
+            return
+        record = {
+            "elapsed_seconds": round(time.perf_counter() - self._started_at, 3),
+            "event": event,
+            "limit": self.limit,
+        }
+        record.update(fields)
+        try:
+            with self.log_path.open("a", encoding="utf-8") as handle:
+                handle.write(json.dumps(record, separators=(",", ":")))
+                handle.write("\n")
+        except OSError as exc:
+            warn(f"Failed to write concurrency log to {self.log_path}: {exc}")
+
+
+class HedgePolicy:
+    """Decide when a slow request should be duplicated, and cap the extra load.
+
+    Once ``min_samples`` latencies have been observed, a request still running after the
+    ``percentile``-th latency is hedged, as long as hedges stay below ``max_ratio`` of all
+    requests.
+    """
+
+    def __init__(
+        self,
+        percentile: float,
+        max_ratio: float,
+        min_samples: int = 20,
+        window: int = 500,
+    ) -> None:
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._lock = Lock()
+
+    def register_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def record_latency(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+
+    def record_win(self, hedge_won: bool) -> None:
+        if hedge_won:
+            with self._lock:
+                self.hedge_wins += 1
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds to wait before hedging, or None while there is too little history."""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            return percentile(self._latencies, self.percentile / 100.0)
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.hedges + 1 > self.max_ratio * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def release(self) -> None:
+        """Give back a hedge from ``try_acquire`` that was never sent."""
+        with self._lock:
+            self.hedges -= 1
+
+
+class TokenBudgetPolicy:
+    """Choose ``max_tokens`` per request from the run's completion lengths.
+
+    Budgets are rungs of a doubling ladder from ``floor`` to ``ceiling``. Until
+    ``min_samples`` completions have been seen every request starts at the ceiling; after
+    that it starts at the lowest rung covering the ``percentile``-th completion length plus
+    ``headroom``. A generation cut off by its budget is re-issued one rung higher.
+    """
+
+    def __init__(
+        self,
+        ceiling: int,
+        floor: int = 1024,
+        percentile: float = 95.0,
+        headroom: float = 1.25,
+        min_samples: int = 20,
+        window: int = 500,
+    ) -> None:
+        self.ceiling = ceiling
+        self.percentile = percentile
+        self.headroom = headroom
+        self.min_samples = min_samples
+        self.rungs: List[int] = []
+        rung = min(floor, ceiling)
+        # Stop doubling early rather than leave a rung just below the ceiling.
+        while rung * 1.5 < ceiling:
+            self.rungs.append(rung)
+            rung *= 2
+        self.rungs.append(ceiling)
+        self.escalations = 0
+        self.rescued = 0
+        self.exhausted = 0
+        self._completions: Deque[int] = deque(maxlen=window)
+        self._lock = Lock()
+
+    def record_completion(self, completion_tokens: int) -> None:
+        with self._lock:
+            self._completions.append(completion_tokens)
+
+    def initial_budget(self) -> int:
+        with self._lock:
+            if len(self._completions) < self.min_samples:
+                return self.ceiling
+            needed = percentile(self._completions, self.percentile / 100.0) * self.headroom
+        return next((rung for rung in self.rungs if rung >= needed), self.ceiling)
+
+    def next_budget(self, budget: int) -> Optional[int]:
+        """The rung above ``budget``, or None once the ceiling was already used."""
+        higher = next((rung for rung in self.rungs if rung > budget), None)
+        with self._lock:
+            if higher is None:
+                self.exhausted += 1
+            else:
+                self.escalations += 1
+        return higher
+
+    def record_rescue(self) -> None:
+        with self._lock:
+            self.rescued += 1
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            completions = list(self._completions)
+            return {
+                "escalations": self.escalations,
+                "rescued": self.rescued,
+                "exhausted": self.exhausted,
+                "completion_percentile": percentile(completions, self.percentile / 100.0),
+                "samples": len(completions),
+            }
+
+
+class CostModel:
+    """Predict how expensive each image's request will be, for longest-job-first dispatch.
+
+    ``history`` maps relative paths to seconds measured in an earlier run (see
+    ``from_details``). Other images are predicted from their pixel count or file size,
+    scaled by the seconds-per-unit of the images that do have history.
+    """
+
+    def __init__(self, basis: str = "pixels", history: Optional[Dict[str, float]] = None) -> None:
+        self.basis = basis
+        self.history = history or {}
+
+    @classmethod
+    def from_details(cls, details_path: Path, basis: str = "pixels") -> "CostModel":
+        """Read per-image latency from a generation-details JSONL written by batch_detect."""
+        history: Dict[str, float] = {}
+        with details_path.open("r", encoding="utf-8") as handle:
+            for line in handle:
+                try:
+                    record = json.loads(line)
+                    if record.get("cache") == "hit":
+                        continue
+                    attempts = record.get("attempts") or []
+                    elapsed = sum(attempt.get("elapsed_seconds", 0.0) for attempt in attempts)
+                    history[record["image"]] = elapsed or float(record["elapsed_seconds"])
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    continue
+        return cls(basis, history)
+
+    def size(self, image_path: Path) -> float:
+        try:
+            if self.basis == "bytes":
+                return float(image_path.stat().st_size)
+            with Image.open(image_path) as image:
+                return float(image.width * image.height)
+        except (OSError, ValueError) as exc:
+            warn(f"Could not size {image_path} for scheduling: {exc}")
+            return 0.0
+
+    def order(self, images: Sequence[Tuple[str, Path]]) -> List[Tuple[str, Path]]:
+        """``images`` as (relative path, path) pairs, most expensive first, ties in input order."""
+        sizes = {rel_path: self.size(path) for rel_path, path in images}
+        known = [rel_path for rel_path, _ in images if rel_path in self.history]
+        known_size = sum(sizes[rel_path] for rel_path in known)
+        if known and known_size > 0:
+            per_unit = sum(self.history[rel_path] for rel_path in known) / known_size
+            costs = {
+                rel_path: self.history.get(rel_path, sizes[rel_path] * per_unit)
+                for rel_path, _ in images
+            }
+        else:
+            costs = sizes
+        return sorted(images, key=lambda item: costs[item[0]], reverse=True)
+
+
+def format_duration(seconds: float) -> str:
+    minutes, secs = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h{minutes:02d}m"
+    if minutes:
+        return f"{minutes}m{secs:02d}s"
+    return f"{secs}s"
+
+
+class RunProgress:
+    """Live throughput, ETA and deadline admission for a batch run.
+
+    Completions and tokens are counted in ``interval``-second buckets whose rates are
+    smoothed with an EWMA (``alpha``), so the ETA follows the current server speed rather
+    than the run's average. Per-request latency is tracked like a TCP retransmission
+    timer (smoothed mean plus four mean deviations); with a ``deadline`` (epoch seconds)
+    ``admits`` refuses new work once a request started now would likely finish after it.
+    ``total`` is the number of images the run expects, when known.
+    """
+
+    def __init__(
+        self,
+        total: Optional[int] = None,
+        deadline: Optional[float] = None,
+        alpha: float = 0.3,
+        interval: float = 5.0,
+    ) -> None:
+        self.total = total
+        self.deadline = deadline
+        self.alpha = alpha
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.tokens = 0
+        self.stop_reason: Optional[str] = None
+        self.started_at = time.monotonic()
+        self._deadline_at = (
+            self.started_at + deadline - time.time() if deadline is not None else None
+        )
+        self._bucket_start = self.started_at
+        self._bucket_done = 0
+        self._bucket_tokens = 0
+        self._images_rate: Optional[float] = None
+        self._tokens_rate: Optional[float] = None
+        self._latency: Optional[float] = None
+        self._latency_deviation = 0.0
+        self._lock = Lock()
+
+    def record(
+        self, seconds: Optional[float] = None, tokens: Optional[int] = None, failed: bool = False
+    ) -> None:
+        """Count one finished image; ``seconds`` is its request time, None for cache hits."""
+        with self._lock:
+            self.done += 1
+            self.failed += failed
+            self.tokens += tokens or 0
+            self._bucket_done += 1
+            self._bucket_tokens += tokens or 0
+            self._fold(time.monotonic())
+            if seconds is not None:
+                if self._latency is None:
+                    self._latency = seconds
+                    self._latency_deviation = seconds / 2
+                else:
+                    self._latency_deviation += 0.25 * (
+                        abs(seconds - self._latency) - self._latency_deviation
+                    )
+                    self._latency += 0.125 * (seconds - self._latency)
+
+    def stop(self, reason: str) -> None:
+        with self._lock:
+            if self.stop_reason is None:
+                self.stop_reason = reason
+
+    def latency_bound(self) -> Optional[float]:
+        with self._lock:
+            if self._latency is None:
+                return None
+            return self._latency + 4 * self._latency_deviation
+
+    def admits(self) -> bool:
+        """Whether a request dispatched now is projected to finish before the deadline."""
+        if self._deadline_at is None:
+            return True
+        bound = self.latency_bound()
+        if time.monotonic() + (bound or 0.0) <= self._deadline_at:
+            return True
+        self.stop("deadline")
+        return False
+
+    def rates(self) -> Tuple[float, float]:
+        """Smoothed (images, tokens) per second; the run average until a bucket completes."""
+        with self._lock:
+            self._fold(time.monotonic())
+            if self._images_rate is not None and self._tokens_rate is not None:
+                return self._images_rate, self._tokens_rate
+            elapsed = max(time.monotonic() - self.started_at, 1e-9)
+            return self.done / elapsed, self.tokens / elapsed
+
+    def eta_seconds(self, remaining: Optional[int] = None) -> Optional[float]:
+        if remaining is None:
+            remaining = self.total - self.done if self.total is not None else None
+        images_rate, _ = self.rates()
+        if remaining is None or images_rate <= 0:
+            return None
+        return max(remaining, 0) / images_rate
+
+    def status(self) -> str:
+        images_rate, tokens_rate = self.rates()
+        done = f"{self.done}/{self.total}" if self.total is not None else str(self.done)
+        eta = self.eta_seconds()
+        return (
+            f"{done}, {images_rate:.2f} img/s, {tokens_rate:.0f} tok/s"
+            + (f", ETA {format_duration(eta)}" if eta is not None else "")
+        )
+
+    def summary(self) -> Dict[str, Any]:
+        images_rate, tokens_rate = self.rates()
+        return {
+            "done": self.done,
+            "failed": self.failed,
+            "tokens": self.tokens,
+            "elapsed_seconds": time.monotonic() - self.started_at,
+            "images_per_second": images_rate,
+            "tokens_per_second": tokens_rate,
+            "latency_bound_seconds": self.latency_bound(),
+            "stop_reason": self.stop_reason,
+        }
+
+    def _fold(self, now: float) -> None:
+        elapsed = now - self._bucket_start
+        if elapsed < self.interval:
+            return
+        images_rate = self._bucket_done / elapsed
+        tokens_rate = self._bucket_tokens / elapsed
+        if self._images_rate is None or self._tokens_rate is None:
+            self._images_rate, self._tokens_rate = images_rate, tokens_rate
+        else:
+            self._images_rate += self.alpha * (images_rate - self._images_rate)
+            self._tokens_rate += self.alpha * (tokens_rate - self._tokens_rate)
+        self._bucket_start = now
+        self._bucket_done = 0
+        self._bucket_tokens = 0
+
+
+class PipelineStats:
+    """Busy time per pipeline stage and depth of the ready queue between them.
+
+    Utilization is busy time over ``workers * wall time``. A prepare stage near 100% with
+    an empty ready queue means the run is disk- or CPU-bound; a full queue with a busy
+    send stage means the server is the bottleneck.
+    """
+
+    def __init__(self, workers: Dict[str, int]) -> None:
+        self.workers = dict(workers)
+        self.started_at = time.perf_counter()
+        self._busy = {stage: 0.0 for stage in workers}
+        self._depth_samples = 0
+        self._depth_total = 0
+        self.max_depth = 0
+        self.starved = 0
+        self._lock = Lock()
+
+    def record_busy(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self._busy[stage] += seconds
+
+    def record_depth(self, depth: int, starved: bool = False) -> None:
+        """Sample the ready queue; ``starved`` marks a free send slot with nothing ready."""
+        with self._lock:
+            self._depth_samples += 1
+            self._depth_total += depth
+            self.max_depth = max(self.max_depth, depth)
+            self.starved += starved
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            elapsed = max(time.perf_counter() - self.started_at, 1e-9)
+            return {
+                "utilization": {
+                    stage: busy / (self.workers[stage] * elapsed)
+                    for stage, busy in self._busy.items()
+                },
+                "mean_depth": self._depth_total / self._depth_samples
+                if self._depth_samples
+                else 0.0,
+                "max_depth": self.max_depth,
+                "starved": self.starved,
+            }
+
+
+class Endpoint:
+    """Bookkeeping for one OpenAI-compatible server behind the balancer.
+
+    ``state`` is the endpoint's circuit breaker: ``closed`` (normal), ``open`` (no traffic
+    until a health probe succeeds) or ``half-open`` (a single trial request is allowed).
+    """
+
+    def __init__(self, api_base: str, max_in_flight: Optional[int] = None) -> None:
+        self.api_base = api_base
+        self.max_in_flight = max_in_flight
+        self.outstanding = 0
+        self.ewma_latency: Optional[float] = None
+        self.consecutive_failures = 0
+        self.state = "closed"
+        self.next_probe_at = 0.0
+        self.trial_in_flight = False
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+
+    def has_capacity(self) -> bool:
+        return self.max_in_flight is None or self.outstanding < self.max_in_flight
+
+
+def load_endpoints_file(path: Path) -> List[Endpoint]:
+    """Read ``URL [MAX_IN_FLIGHT]`` lines; blank lines and ``#`` comments are ignored."""
+    endpoints: List[Endpoint] = []
+    with path.open("r", encoding="utf-8") as handle:
+        for line_number, line in enumerate(handle, 1):
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            if len(fields) > 2:
+                raise ValueError(f"Expected 'URL [MAX_IN_FLIGHT]' at {path}:{line_number}")
+            try:
+                cap = int(fields[1]) if len(fields) == 2 else None
+            except ValueError as exc:
+                raise ValueError(f"Invalid in-flight cap at {path}:{line_number}: {exc}") from exc
+            endpoints.append(Endpoint(fields[0], cap))
+    return endpoints
+
+
+class EndpointBalancer:
+    """Client-side load balancer over one or more vLLM replicas.
+
+    ``least-outstanding`` routes to the endpoint with the fewest requests in flight;
+    ``ewma`` weighs that count by each endpoint's exponentially weighted latency, so slow
+    replicas receive proportionally less work.
+
+    Each endpoint has a circuit breaker: ``eject_after`` consecutive transport failures open
+    it and no new requests are routed there. Every ``eject_seconds`` the engine's prober
+    checks open endpoints (see ``due_probes``); a successful probe half-opens the breaker
+    and the next request is a trial that closes it again or re-opens it. While every
+    endpoint is open, ``acquire`` blocks, pausing dispatch until a replica recovers or
+    ``stop`` is called.
+    """
+
+    def __init__(
+        self,
+        endpoints: Sequence[Endpoint],
+        strategy: str = "least-outstanding",
+        eject_after: int = 5,
+        eject_seconds: float = 30.0,
+        ewma_alpha: float = 0.3,
+    ) -> None:
+        if not endpoints:
+            raise ValueError("At least one endpoint is required.")
+        self.endpoints = list(endpoints)
+        self.strategy = strategy
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.ewma_alpha = ewma_alpha
+        self._next_index = 0
+        self._condition = Condition()
+        self.stopping = Event()
+
+    def stop(self) -> None:
+        """Make waiting and future ``acquire`` calls raise a ``cancelled`` DetectionError."""
+        self.stopping.set()
+        with self._condition:
+            self._condition.notify_all()
+
+    def acquire(self, avoid: Optional[Endpoint] = None) -> Endpoint:
+        """Block until an endpoint is usable and below its in-flight cap, then reserve it.
+
+        ``avoid`` is skipped when any other endpoint is available (used for hedged requests).
+        """
+        with self._condition:
+            while True:
+                if self.stopping.is_set():
+                    raise DetectionError(
+                        "Stopped while waiting for an endpoint.", kind="cancelled"
+                    )
+                endpoint = self._pick(avoid)
+                if endpoint is not None:
+                    return endpoint
+                self._condition.wait(timeout=1.0)
+
+    def try_acquire(self, avoid: Optional[Endpoint] = None) -> Optional[Endpoint]:
+        with self._condition:
+            return self._pick(avoid)
+
+    def release(
+        self, endpoint: Endpoint, latency: float, error: Optional[DetectionError] = None
+    ) -> None:
+        with self._condition:
+            endpoint.outstanding -= 1
+            endpoint.requests += 1
+            if endpoint.state == "half-open" and endpoint.trial_in_flight:
+                endpoint.trial_in_flight = False
+            if error is not None and is_retryable_error(error):
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.state == "half-open" or (
+                    endpoint.state == "closed"
+                    and endpoint.consecutive_failures >= self.eject_after
+                ):
+                    self._open(endpoint)
+            elif error is None:
+                endpoint.consecutive_failures = 0
+                if endpoint.state == "half-open":
+                    endpoint.state = "closed"
+                    print(f"Circuit closed for {endpoint.api_base}; resuming traffic.")
+                if endpoint.ewma_latency is None:
+                    endpoint.ewma_latency = latency
+                else:
+                    endpoint.ewma_latency += self.ewma_alpha * (latency - endpoint.ewma_latency)
+            self._condition.notify_all()
+
+    def breaker_open(self, api_base: Optional[str]) -> bool:
+        """Whether the circuit breaker for ``api_base`` is currently open."""
+        with self._condition:
+            return any(
+                endpoint.api_base == api_base and endpoint.state == "open"
+                for endpoint in self.endpoints
+            )
+
+    def due_probes(self) -> List[Endpoint]:
+        """Return open endpoints whose next health probe is due, and schedule the one after."""
+        now = time.monotonic()
+        with self._condition:
+            due = [ep for ep in self.endpoints if ep.state == "open" and ep.next_probe_at <= now]
+            for endpoint in due:
+                endpoint.next_probe_at = now + self.eject_seconds
+            return due
+
+    def probe_result(self, endpoint: Endpoint, healthy: bool) -> None:
+        with self._condition:
+            if not healthy or endpoint.state != "open":
+                return
+            endpoint.state = "half-open"
+            endpoint.trial_in_flight = False
+            print(f"Health probe succeeded for {endpoint.api_base}; sending a trial request.")
+            self._condition.notify_all()
+
+    def summary(self) -> List[Dict[str, Any]]:
+        with self._condition:
+            return [
+                {
+                    "api_base": endpoint.api_base,
+                    "requests": endpoint.requests,
+                    "failures": endpoint.failures,
+                    "ejections": endpoint.ejections,
+                    "ewma_latency_seconds": endpoint.ewma_latency,
+                }
+                for endpoint in self.endpoints
+            ]
+
+    def _open(self, endpoint: Endpoint) -> None:
+        endpoint.state = "open"
+        endpoint.trial_in_flight = False
+        endpoint.next_probe_at = time.monotonic() + self.eject_seconds
+        endpoint.ejections += 1
+        warn(
+            f"Circuit open for {endpoint.api_base} after {endpoint.consecutive_failures} "
+            f"consecutive failures; probing every {self.eject_seconds:.0f}s."
+        )
+
+    def _pick(self, avoid: Optional[Endpoint] = None) -> Optional[Endpoint]:
+        candidates: List[Endpoint] = []
+        for endpoint in self.endpoints:
+            if endpoint.state == "open":
+                continue
+            if endpoint.state == "half-open" and endpoint.trial_in_flight:
+                continue
+            if endpoint.has_capacity():
+                candidates.append(endpoint)
+        if avoid is not None and len(candidates) > 1:
+            candidates = [endpoint for endpoint in candidates if endpoint is not avoid]
+        if not candidates:
+            return None
+
+        # Rotate the starting point so ties do not always land on the first endpoint.
+        self._next_index = (self._next_index + 1) % len(self.endpoints)
+        order = {id(endpoint): index for index, endpoint in enumerate(self.endpoints)}
+        candidates.sort(
+            key=lambda ep: (order[id(ep)] - self._next_index) % len(self.endpoints)
+        )
+        chosen = min(candidates, key=self._score)
+        chosen.outstanding += 1
+        if chosen.state == "half-open":
+            chosen.trial_in_flight = True
+        return chosen
+
+    def _score(self, endpoint: Endpoint) -> float:
+        if self.strategy == "ewma":
+            latency = endpoint.ewma_latency
+            if latency is None:
+                # Unmeasured endpoints look as fast as the fastest known one until they report.
+                known = [ep.ewma_latency for ep in self.endpoints if ep.ewma_latency is not None]
+                latency = min(known) if known else 1.0
+            return (endpoint.outstanding + 1) * latency
+        return float(endpoint.outstanding)
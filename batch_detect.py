@@ -1,35 +1,104 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
+import hashlib
 import json
+import operator
+import os
 import signal
 import sys
 import time
 from collections import deque
-from concurrent.futures import ThreadPoolExecutor, as_completed, Future
-from json import JSONDecodeError
+from datetime import datetime, timedelta
+from itertools import chain, islice
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait, Future
 from pathlib import Path
-from threading import Lock
-from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+from threading import Event, Thread
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
 
+try:
+    import resource
+except ImportError:  # pragma: no cover - not available on Windows
+    resource = None
+
+from batch_common import (
+    PendingImages,
+    TokenEscalation,
+    TokenLadder,
+    build_cached_record,
+    build_detection_record,
+    build_failure_entry,
+    build_failure_record,
+    prepare_request,
+    queue_completion,
+    report_early_stop,
+    request_seconds,
+    total_tokens,
+    write_arguments_file,
+)
+from batch_control import (
+    AdaptiveConcurrency,
+    CostModel,
+    Endpoint,
+    EndpointBalancer,
+    HedgePolicy,
+    PipelineStats,
+    RetryPolicy,
+    RunProgress,
+    TokenBudgetPolicy,
+    describe_attempt,
+    format_duration,
+    is_retryable_error,
+    load_endpoints_file,
+)
 from query_bbox import (
+    CancelToken,
     DetectionError,
-    encode_image,
-    extract_detections,
+    IMAGE_PLACEHOLDER,
+    IMAGE_TRANSPORTS,
+    PayloadTemplate,
+    add_image_encoding_arguments,
+    image_encoding_from_args,
     request_completion,
-    sanitize_detections,
+    request_completion_stream,
     build_payload,
     load_example_pairs,
     load_context_images,
-    format_debug_info,
+    configure_http_session,
+    print_http_session_stats,
+    print_image_transport_stats,
+    probe_endpoint,
+    streaming_payload,
 )
+from record_writer import DETAILS_LEVELS, FSYNC_POLICIES, RecordWriter, derive_cot_path
+from response_cache import CACHE_MODES, ResponseCache
+from work_queue import WorkQueue
 
 DEFAULT_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp"}
+DEFAULT_API_BASE = "http://127.0.0.1:8000/v1"
 
 
 def warn(message: str) -> None:
     print(f"Warning: {message}", file=sys.stderr)
 
 
+def parse_deadline(value: str) -> float:
+    """Epoch seconds for an ISO date-time, or the next occurrence of a clock time (HH:MM)."""
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        try:
+            clock = datetime.strptime(value, "%H:%M").time()
+        except ValueError as exc:
+            raise argparse.ArgumentTypeError(
+                f"expected HH:MM or an ISO date-time, got {value!r}"
+            ) from exc
+        moment = datetime.combine(datetime.now().date(), clock)
+        if moment <= datetime.now():
+            moment += timedelta(days=1)
+    return moment.timestamp()
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="Run batched object detection over a dataset tree using the Qwen3-VL model."
@@ -39,8 +108,51 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("results_path", type=Path, help="Path to the JSONL results file.")
     parser.add_argument(
         "--api-base",
-        default="http://127.0.0.1:8000/v1",
-        help="Base URL for the OpenAI-compatible endpoint (default: %(default)s).",
+        action="append",
+        help=(
+            f"Base URL for the OpenAI-compatible endpoint (default: {DEFAULT_API_BASE}). "
+            "Repeat to balance requests across several replicas."
+        ),
+    )
+    parser.add_argument(
+        "--endpoints-file",
+        type=Path,
+        help=(
+            "File listing additional endpoints, one 'URL [MAX_IN_FLIGHT]' per line "
+            "('#' starts a comment)."
+        ),
+    )
+    parser.add_argument(
+        "--balance",
+        choices=("least-outstanding", "ewma"),
+        default="least-outstanding",
+        help=(
+            "How to route requests across endpoints: fewest in-flight requests, or in-flight "
+            "requests weighted by EWMA latency (default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--endpoint-max-in-flight",
+        type=int,
+        help="Per-endpoint cap on in-flight requests (endpoints-file entries may override it).",
+    )
+    parser.add_argument(
+        "--eject-after",
+        type=int,
+        default=5,
+        help=(
+            "Consecutive transport failures after which an endpoint's circuit breaker opens "
+            "and it is taken out of rotation (default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--eject-seconds",
+        type=float,
+        default=30.0,
+        help=(
+            "Seconds between health probes (GET /models) of an endpoint whose circuit breaker "
+            "is open (default: %(default)s)."
+        ),
     )
     parser.add_argument(
         "--model",
@@ -95,23 +207,368 @@ def parse_args() -> argparse.Namespace:
         default=120.0,
         help="Request timeout in seconds for the model API.",
     )
+    parser.add_argument(
+        "--image-transport",
+        choices=IMAGE_TRANSPORTS,
+        default="base64",
+        help=(
+            "How images reach the server: inline base64 data URLs, or file:// paths for vLLM "
+            "servers started with --allowed-local-media-path on a shared filesystem "
+            "(default: %(default)s)."
+        ),
+    )
+    add_image_encoding_arguments(parser)
+    parser.add_argument(
+        "--cache-mode",
+        choices=CACHE_MODES,
+        default="off",
+        help=(
+            "Response cache keyed by image content, prompts, model and decoding parameters. "
+            "read-write serves hits and stores new responses, read-only never writes, refresh "
+            "re-queries everything and overwrites entries (default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--cache-path",
+        type=Path,
+        help=(
+            "SQLite file for --cache-mode. Defaults to 'response_cache.sqlite' next to the "
+            "results file, so reruns into the same directory share it."
+        ),
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=float,
+        default=1024.0,
+        help=(
+            "Size bound for the response cache; least recently used entries are evicted "
+            "(default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help=(
+            "Stream completions (SSE) and record time to first token and inter-token latency "
+            "under stream_metrics in the generation details."
+        ),
+    )
+    parser.add_argument(
+        "--stream-early-stop",
+        action="store_true",
+        help=(
+            "Implies --stream; close each stream as soon as the detection array is complete "
+            "instead of waiting for the server to finish."
+        ),
+    )
     parser.add_argument(
         "--max-workers",
         type=int,
         default=4,
         help="Maximum number of concurrent requests (default: %(default)s).",
     )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=3,
+        help=(
+            "Retries per image for transient failures (timeouts, connection errors, HTTP 429/5xx). "
+            "Unparseable model output is never retried (default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--retry-base-delay",
+        type=float,
+        default=1.0,
+        help="Base delay in seconds for exponential backoff with full jitter (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--retry-max-delay",
+        type=float,
+        default=30.0,
+        help="Upper bound in seconds for a single backoff delay (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--max-requeues",
+        type=int,
+        default=5,
+        help=(
+            "Times per image a request is moved off an endpoint whose circuit breaker opened "
+            "without spending a retry; later failures count against --max-retries "
+            "(default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--retry-budget",
+        type=float,
+        default=0.1,
+        help=(
+            "Run-wide cap on retries as a fraction of images requested (plus a floor of 10), "
+            "so an unhealthy server is not hit with a retry storm (default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        help=(
+            "Enable hedged requests: when a request runs longer than this percentile of observed "
+            "latencies (e.g. 95), send a duplicate, preferably to another endpoint, keep the "
+            "first good answer and cancel the other. With the thread engine this streams every "
+            "request (as --stream does) so the losing copy can be aborted mid-generation; "
+            "--timeout then bounds each read of the stream rather than the whole request."
+        ),
+    )
+    parser.add_argument(
+        "--hedge-max-ratio",
+        type=float,
+        default=0.05,
+        help="Maximum hedged duplicates as a fraction of requests (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--hedge-min-samples",
+        type=int,
+        default=20,
+        help="Latency samples to collect before hedging starts (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--adaptive-concurrency",
+        action="store_true",
+        help=(
+            "Adjust the number of in-flight requests at runtime (AIMD), treating --max-workers "
+            "as the ceiling. Concurrency grows while p95 latency and the error rate stay within "
+            "target and is halved on timeouts, HTTP 429/503 or latency spikes."
+        ),
+    )
+    parser.add_argument(
+        "--min-workers",
+        type=int,
+        default=1,
+        help="Lower bound (and starting point) for --adaptive-concurrency (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--target-p95",
+        type=float,
+        help=(
+            "p95 request latency in seconds that --adaptive-concurrency should stay under. "
+            "Defaults to half of --timeout."
+        ),
+    )
+    parser.add_argument(
+        "--max-error-rate",
+        type=float,
+        default=0.05,
+        help=(
+            "Transport/HTTP error rate above which --adaptive-concurrency stops growing "
+            "(default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--concurrency-log-path",
+        type=Path,
+        help=(
+            "Optional path for the JSONL log of concurrency changes made by --adaptive-concurrency. "
+            "Defaults to a file alongside the results, prefixed with 'concurrency_'."
+        ),
+    )
+    parser.add_argument(
+        "--engine",
+        choices=("threads", "asyncio"),
+        default="threads",
+        help=(
+            "Concurrency engine: a thread per in-flight request, or a single asyncio event loop "
+            "that can keep hundreds of requests in flight (requires aiohttp) (default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--prepare-workers",
+        type=int,
+        default=min(4, os.cpu_count() or 1),
+        help=(
+            "Threads that read, resize and encode images ahead of the network workers "
+            "(default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        help=(
+            "How many prepared requests may wait for a free network worker "
+            "(default: 2x --max-workers)."
+        ),
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        help=(
+            "Number of keep-alive HTTP connections to keep open to the endpoint. "
+            "Defaults to --max-workers."
+        ),
+    )
     parser.add_argument(
         "--extensions",
         nargs="*",
         default=sorted(DEFAULT_EXTENSIONS),
         help="Image file extensions to include (default: common formats).",
     )
+    parser.add_argument(
+        "--file-list",
+        type=Path,
+        help=(
+            "Snapshot of the dataset's image paths. Read instead of walking the tree when it "
+            "exists; otherwise written once a full walk completes."
+        ),
+    )
+    parser.add_argument(
+        "--refresh-file-list",
+        action="store_true",
+        help="Walk the tree even if --file-list exists, and rewrite the snapshot.",
+    )
+    parser.add_argument(
+        "--work-queue",
+        type=Path,
+        help=(
+            "SQLite work queue shared by cooperating batch_detect processes. The first process "
+            "seeds it from the dataset scan; every process claims images with a lease, so any "
+            "number of workers can join or leave the run. Give each worker its own results path."
+        ),
+    )
+    parser.add_argument(
+        "--lease-seconds",
+        type=float,
+        default=600.0,
+        help=(
+            "How long a claimed image stays reserved after its worker stops renewing the lease "
+            "(crash or hang) before another worker may take it (default: 600)."
+        ),
+    )
+    parser.add_argument(
+        "--schedule",
+        choices=("scan", "largest-first"),
+        default="scan",
+        help=(
+            "Dispatch order: scan order (default, starts immediately) or largest-first, which "
+            "collects the pending images and sends the most expensive ones first to shorten "
+            "the tail of the run."
+        ),
+    )
+    parser.add_argument(
+        "--cost-basis",
+        choices=("pixels", "bytes"),
+        default="pixels",
+        help="Image size measure used to predict request cost for --schedule largest-first.",
+    )
+    parser.add_argument(
+        "--cost-history",
+        type=Path,
+        help=(
+            "Generation-details JSONL from an earlier run; its per-image latencies drive "
+            "--schedule largest-first, and calibrate predictions for unseen images."
+        ),
+    )
+    parser.add_argument(
+        "--shard-count",
+        type=int,
+        default=1,
+        help=(
+            "Split the dataset into this many shards by a stable hash of each relative path, "
+            "e.g. one per machine. Merge the outputs with merge_shards.py."
+        ),
+    )
+    parser.add_argument(
+        "--shard-index",
+        type=int,
+        default=0,
+        help="Which shard this run processes, from 0 to --shard-count - 1.",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help=(
+            "Dry run: read only image headers and print the vision tokens, prompt tokens, "
+            "payload bytes and projected wall time the run would cost. Sends no requests and "
+            "writes no files."
+        ),
+    )
+    parser.add_argument(
+        "--max-model-len",
+        type=int,
+        default=262144,
+        help=(
+            "Context length of the served model; --plan flags requests whose prompt plus "
+            "--max-tokens exceeds it (default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "--plan-tokens-per-second",
+        type=float,
+        help=(
+            "Aggregate server throughput (prompt plus completion tokens per second) for the "
+            "--plan wall-time projection. Defaults to the per-request rate measured in "
+            "--cost-history times --max-workers."
+        ),
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        metavar="SECONDS",
+        help=(
+            "Stop dispatching new images once a request started now would likely finish more "
+            "than this many seconds after the run started. In-flight requests complete and "
+            "what remains is summarized for a later --resume."
+        ),
+    )
+    parser.add_argument(
+        "--deadline",
+        type=parse_deadline,
+        metavar="WHEN",
+        help=(
+            "Like --time-budget, but at a wall-clock time: HH:MM (the next occurrence) or an "
+            "ISO date-time such as 2026-10-18T18:00."
+        ),
+    )
     parser.add_argument(
         "--limit",
         type=int,
         help="Optional limit on the number of images to process.",
     )
+    parser.add_argument(
+        "--fsync",
+        choices=FSYNC_POLICIES,
+        default="never",
+        help=(
+            "When to fsync the results and details files: never (leave it to the OS), after "
+            "every buffered flush, or after every record."
+        ),
+    )
+    parser.add_argument(
+        "--flush-interval",
+        type=float,
+        default=1.0,
+        help="Seconds buffered output may wait before it is written (default: 1.0).",
+    )
+    parser.add_argument(
+        "--flush-kb",
+        type=float,
+        default=1024,
+        help="Write buffered output once this many KiB are pending (default: 1024).",
+    )
+    parser.add_argument(
+        "--failures-path",
+        type=Path,
+        help=(
+            "Failure ledger JSONL (image, error kind, attempts, finish reason, elapsed time). "
+            "Defaults to a file alongside the results, prefixed with 'failures_'."
+        ),
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help=(
+            "Process only the images with unresolved entries in the failure ledger instead of "
+            "scanning the dataset. Combine with overrides such as a larger --max-tokens or "
+            "another --api-base."
+        ),
+    )
     parser.add_argument(
         "--resume",
         action="store_true",
@@ -138,6 +595,39 @@ def parse_args() -> argparse.Namespace:
             "Defaults to a file alongside the results, prefixed with 'generation_details_'."
         ),
     )
+    parser.add_argument(
+        "--escalate-max-tokens",
+        action="store_true",
+        help=(
+            "Treat --max-tokens as a ceiling: start each request at a budget learned from the "
+            "run's completion lengths and re-issue truncated generations at doubling budgets."
+        ),
+    )
+    parser.add_argument(
+        "--min-max-tokens",
+        type=int,
+        default=1024,
+        help="Lowest budget on the --escalate-max-tokens ladder (default: 1024).",
+    )
+    parser.add_argument(
+        "--max-tokens-percentile",
+        type=float,
+        default=95.0,
+        help=(
+            "Completion-length percentile (plus 25%% headroom) the starting budget must cover "
+            "with --escalate-max-tokens (default: 95)."
+        ),
+    )
+    parser.add_argument(
+        "--details-level",
+        choices=DETAILS_LEVELS,
+        default="full",
+        help=(
+            "How much to keep in the generation details: none (no file), usage (timing, finish "
+            "reason, token usage, attempts) or full (everything, with chain-of-thought stored "
+            "once in a gzip stream next to the details file)."
+        ),
+    )
     parser.add_argument(
         "--generation-arguments-path",
         type=Path,
@@ -154,29 +644,167 @@ def normalize_extensions(exts: Iterable[str]) -> Set[str]:
     return {ext.lower() if ext.startswith(".") else f".{ext.lower()}" for ext in exts}
 
 
-def find_images(root: Path, extensions: Set[str]) -> List[Path]:
-    return [
-        path
-        for path in sorted(root.rglob("*"))
-        if path.is_file() and path.suffix.lower() in extensions
-    ]
+def _sorted_entries(directory: str) -> Iterator["os.DirEntry[str]"]:
+    try:
+        with os.scandir(directory) as scan:
+            return iter(sorted(scan, key=lambda entry: entry.name))
+    except OSError as exc:
+        warn(f"Skipping unreadable directory {directory}: {exc}")
+        return iter(())
+
 
+def find_images(root: Path, extensions: Set[str]) -> Iterator[Path]:
+    """Yield image files under ``root`` as the walk reaches them.
 
-def load_existing_results(results_path: Path) -> Dict[str, Dict[str, Any]]:
-    processed: Dict[str, Dict[str, Any]] = {}
+    Each directory is listed once with ``os.scandir`` and walked depth-first in name order,
+    which matches sorting every path. Only entries with a matching extension are stat-ed,
+    and directory symlinks are not followed.
+    """
+    stack = [_sorted_entries(str(root))]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+        elif entry.is_dir(follow_symlinks=False):
+            stack.append(_sorted_entries(entry.path))
+        elif os.path.splitext(entry.name)[1].lower() in extensions and entry.is_file():
+            yield Path(entry.path)
+
+
+def shard_of(rel_path: str, shard_count: int) -> int:
+    """Stable shard for ``rel_path``: adding or removing files never moves other files."""
+    digest = hashlib.sha1(rel_path.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shard_count
+
+
+class DatasetScan:
+    """Lazily enumerate the dataset's images, optionally through a persisted file list.
+
+    Without a usable snapshot the tree is walked with ``find_images``; when
+    ``file_list_path`` is given, the walk is recorded there (one relative path per line)
+    and only committed once it completes, so later runs can skip the walk. A snapshot whose
+    header does not match the dataset root and extensions is ignored. With ``record`` off
+    an existing snapshot is still read, but a walk never writes one.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        extensions: Set[str],
+        file_list_path: Optional[Path] = None,
+        refresh: bool = False,
+        record: bool = True,
+    ) -> None:
+        self.root = root
+        self.extensions = extensions
+        self.file_list_path = file_list_path
+        self.refresh = refresh
+        self.record = record
+        self.count = 0
+        self.header = f"# batch_detect file list root={root} extensions={','.join(sorted(extensions))}"
+        self._snapshot = self._check_snapshot()
+
+    def snapshot_size(self) -> Optional[int]:
+        """Number of images in a usable file-list snapshot, without yielding them."""
+        if not self.uses_snapshot():
+            return None
+        assert self.file_list_path is not None
+        with self.file_list_path.open("rb") as handle:
+            return sum(1 for line in handle if line.strip()) - 1
+
+    def uses_snapshot(self) -> bool:
+        """Whether iteration reads the file list; decided once, when the scan is created."""
+        return self._snapshot
+
+    def _check_snapshot(self) -> bool:
+        if self.file_list_path is None or self.refresh or not self.file_list_path.is_file():
+            return False
+        with self.file_list_path.open("r", encoding="utf-8") as handle:
+            if handle.readline().rstrip("\n") == self.header:
+                return True
+        warn(f"File list {self.file_list_path} was made for another dataset; rescanning.")
+        return False
+
+    def __iter__(self) -> Iterator[Path]:
+        if self.uses_snapshot():
+            assert self.file_list_path is not None
+            with self.file_list_path.open("r", encoding="utf-8") as handle:
+                handle.readline()
+                for line in handle:
+                    rel_path = line.rstrip("\n")
+                    if rel_path:
+                        self.count += 1
+                        yield self.root / rel_path
+            return
+        if self.file_list_path is None or not self.record:
+            for path in find_images(self.root, self.extensions):
+                self.count += 1
+                yield path
+            return
+
+        partial = self.file_list_path.with_name(f"{self.file_list_path.name}.partial")
+        partial.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            with partial.open("w", encoding="utf-8") as handle:
+                handle.write(self.header + "\n")
+                for path in find_images(self.root, self.extensions):
+                    handle.write(path.relative_to(self.root).as_posix() + "\n")
+                    self.count += 1
+                    yield path
+        except BaseException:
+            # An interrupted walk (including --limit stopping early) must not become a snapshot.
+            partial.unlink(missing_ok=True)
+            raise
+        os.replace(partial, self.file_list_path)
+        print(f"Saved file list of {self.count} images to {self.file_list_path}")
+
+
+_RECORD_PREFIX = b'{"image":"'
+
+
+def record_key(line: bytes) -> str:
+    """Return the ``image`` key of one raw JSONL record line.
+
+    Records written by this script start with the image key and end with the detections
+    array, so the key is sliced out of the raw line without decoding the rest; any other
+    line is parsed in full. A line cut off by a crash has no newline (or, once a resumed run
+    appended to it, a second record), so it is parsed too and raises ``ValueError`` like
+    any malformed record.
+    """
+    stripped = line.strip()
+    if (
+        line.endswith(b"\n")
+        and stripped.startswith(_RECORD_PREFIX)
+        and stripped.endswith(b"]}")
+        and stripped.find(_RECORD_PREFIX, 1) < 0
+    ):
+        end = stripped.find(b'"', len(_RECORD_PREFIX))
+        key = stripped[len(_RECORD_PREFIX) : end]
+        if end > 0 and b"\\" not in key:
+            return key.decode("utf-8")
+    try:
+        return json.loads(stripped)["image"]
+    except (UnicodeDecodeError, KeyError, TypeError) as exc:
+        raise ValueError(str(exc)) from exc
+
+
+def load_processed_paths(results_path: Path) -> Set[str]:
+    """Return the ``image`` keys already recorded in ``results_path``.
+
+    Only the keys are extracted (see ``record_key``), so startup cost and memory scale with
+    the number of keys, not with payload size.
+    """
+    processed: Set[str] = set()
     if not results_path.exists():
         return processed
 
-    with results_path.open("r", encoding="utf-8") as handle:
+    with results_path.open("rb") as handle:
         for line_number, line in enumerate(handle, 1):
-            stripped = line.strip()
-            if not stripped:
+            if not line.strip():
                 continue
             try:
-                record = json.loads(stripped)
-                rel_path = record["image"]
-                processed[rel_path] = record
-            except (JSONDecodeError, KeyError) as exc:
+                processed.add(record_key(line))
+            except ValueError as exc:
                 warn(f"Skipping malformed record at line {line_number}: {exc}")
     return processed
 
@@ -187,24 +815,45 @@ def ensure_output_directory(results_path: Path) -> None:
         parent.mkdir(parents=True, exist_ok=True)
 
 
-def append_result(results_path: Path, lock: Lock, record: Dict[str, Any]) -> None:
-    payload = json.dumps(record, separators=(",", ":"))
-    with lock:
-        with results_path.open("a", encoding="utf-8") as handle:
-            handle.write(payload)
-            handle.write("\n")
+def derive_details_path(results_path: Path) -> Path:
+    return results_path.with_name(f"generation_details_{results_path.name}")
 
 
-def append_generation_details(details_path: Path, lock: Lock, record: Dict[str, Any]) -> None:
-    payload = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
-    with lock:
-        with details_path.open("a", encoding="utf-8") as handle:
-            handle.write(payload)
-            handle.write("\n")
+def derive_failures_path(results_path: Path) -> Path:
+    return results_path.with_name(f"failures_{results_path.name}")
 
 
-def derive_details_path(results_path: Path) -> Path:
-    return results_path.with_name(f"generation_details_{results_path.name}")
+def load_failures(failures_path: Path) -> Dict[str, Dict[str, Any]]:
+    """Latest ledger entry of every image whose failure has not been resolved since."""
+    failures: Dict[str, Dict[str, Any]] = {}
+    if not failures_path.exists():
+        return failures
+    with failures_path.open("r", encoding="utf-8") as handle:
+        for line_number, line in enumerate(handle, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                rel_path = entry["image"]
+            except (ValueError, KeyError, TypeError) as exc:
+                warn(f"Skipping malformed failure entry at line {line_number}: {exc}")
+                continue
+            failures.pop(rel_path, None)
+            if not entry.get("resolved"):
+                failures[rel_path] = entry
+    return failures
+
+
+def derive_remaining_path(results_path: Path) -> Path:
+    return results_path.with_name(f"remaining_{results_path.stem}.json")
+
+
+def derive_cache_path(results_path: Path) -> Path:
+    return results_path.with_name("response_cache.sqlite")
+
+
+def derive_concurrency_log_path(results_path: Path) -> Path:
+    return results_path.with_name(f"concurrency_{results_path.name}")
 
 
 def derive_arguments_path(results_path: Path) -> Path:
@@ -226,71 +875,411 @@ def serialize_args_for_json(args: argparse.Namespace) -> Dict[str, Any]:
     return {key: normalize(value) for key, value in vars(args).items()}
 
 
-def write_arguments_file(path: Path, payload: Dict[str, Any]) -> None:
-    try:
-        path.parent.mkdir(parents=True, exist_ok=True)
-        with path.open("w", encoding="utf-8") as handle:
-            json.dump(payload, handle, ensure_ascii=False, indent=2)
-    except OSError as exc:
-        warn(f"Failed to write arguments file to {path}: {exc}")
-
-
-def detect_single_image(
-    image_path: Path,
-    rel_path: str,
-    prompt: str,
-    model: str,
-    temperature: float,
-    top_p: float,
-    top_k: int,
-    repetition_penalty: float,
-    presence_penalty: float,
-    seed: int,
-    max_tokens: int,
-    api_base: str,
-    timeout: float,
+def build_payload_template(
+    args: argparse.Namespace,
     examples: Optional[Sequence[Tuple[str, str]]] = None,
     context_images: Optional[Sequence[str]] = None,
-) -> Tuple[str, List[Dict[str, Any]], Dict[str, Any]]:
-    image_data = encode_image(image_path)
+    stream: bool = False,
+    max_tokens: Optional[int] = None,
+) -> PayloadTemplate:
+    """Serialize everything but the target image once for the whole run."""
     payload = build_payload(
-        prompt,
-        image_data,
-        model,
-        temperature,
-        max_tokens,
-        top_p,
-        top_k,
-        repetition_penalty,
-        presence_penalty,
-        seed,
+        args.prompt,
+        IMAGE_PLACEHOLDER,
+        args.model,
+        args.temperature,
+        max_tokens if max_tokens is not None else args.max_tokens,
+        args.top_p,
+        args.top_k,
+        args.repetition_penalty,
+        args.presence_penalty,
+        args.seed,
         examples=examples,
         context_images=context_images,
     )
+    if stream:
+        payload = streaming_payload(payload)
+    return PayloadTemplate(payload, image_encoding_from_args(args))
+
+
+def peak_rss_bytes() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def resolve_endpoints(args: argparse.Namespace) -> List[Endpoint]:
+    endpoints = [Endpoint(url, args.endpoint_max_in_flight) for url in (args.api_base or [])]
+    if args.endpoints_file is not None:
+        for endpoint in load_endpoints_file(args.endpoints_file):
+            if endpoint.max_in_flight is None:
+                endpoint.max_in_flight = args.endpoint_max_in_flight
+            endpoints.append(endpoint)
+    if not endpoints:
+        endpoints.append(Endpoint(DEFAULT_API_BASE, args.endpoint_max_in_flight))
+    return endpoints
+
+
+def run_health_prober(balancer: EndpointBalancer, stop_event: Event) -> None:
+    """Probe endpoints with an open circuit breaker until ``stop_event`` is set."""
+    while not stop_event.wait(0.5):
+        for endpoint in balancer.due_probes():
+            balancer.probe_result(endpoint, probe_endpoint(endpoint.api_base))
+
+
+def run_attempt(
+    send: Callable[[str, Optional[CancelToken]], Dict[str, Any]],
+    balancer: EndpointBalancer,
+    endpoint: Endpoint,
+    controller: Optional[AdaptiveConcurrency] = None,
+    cancel: Optional[CancelToken] = None,
+) -> Dict[str, Any]:
+    """Send one request to an endpoint already reserved from ``balancer`` and release it."""
     start_time = time.perf_counter()
-    body = request_completion(api_base, payload, timeout)
+    try:
+        body = send(endpoint.api_base, cancel)
+    except DetectionError as exc:
+        elapsed = time.perf_counter() - start_time
+        exc.endpoint = endpoint.api_base
+        balancer.release(endpoint, elapsed, exc)
+        if controller is not None and exc.kind != "cancelled":
+            controller.record(start_time, elapsed, exc)
+        raise
     elapsed = time.perf_counter() - start_time
-    detections, raw_text, raw_body, metadata = extract_detections(body)
-    detections = list(detections)
-    sanitized = sanitize_detections(detections)
-    if detections and not sanitized:
-        raise DetectionError(
-            f"Image '{rel_path}' produced detections but none were usable."
-            + format_debug_info(raw_text, raw_body)
+    balancer.release(endpoint, elapsed)
+    if controller is not None:
+        controller.record(start_time, elapsed)
+    return body
+
+
+def run_hedged_attempt(
+    send: Callable[[str, Optional[CancelToken]], Dict[str, Any]],
+    balancer: EndpointBalancer,
+    hedge_policy: HedgePolicy,
+    hedge_executor: ThreadPoolExecutor,
+    controller: Optional[AdaptiveConcurrency] = None,
+) -> Tuple[Dict[str, Any], str, Dict[str, Any]]:
+    """Run one attempt, duplicating it on another endpoint if it outlives the hedge delay.
+
+    The first successful copy wins and the other is cancelled. Returns the body, the
+    endpoint that produced it and hedge details for the attempt log. A stop while waiting
+    for a hedge endpoint skips the hedge; the primary still runs to completion.
+
+    Only the primary's latency feeds the hedge delay (a lower bound when the hedge won):
+    the winner's would pull the percentile down as hedging grows, and hedge more.
+    """
+    primary_endpoint = balancer.acquire()
+    primary_started = time.perf_counter()
+    copies: Dict["Future[Dict[str, Any]]", Tuple[str, str, CancelToken]] = {}
+    primary_cancel = CancelToken()
+    primary = hedge_executor.submit(
+        run_attempt, send, balancer, primary_endpoint, controller, primary_cancel
+    )
+    copies[primary] = ("primary", primary_endpoint.api_base, primary_cancel)
+
+    delay = hedge_policy.hedge_delay()
+    if delay is not None:
+        done, _ = wait([primary], timeout=delay)
+        if not done and hedge_policy.try_acquire():
+            try:
+                hedge_endpoint = balancer.acquire(avoid=primary_endpoint)
+            except DetectionError:
+                hedge_policy.release()
+            else:
+                hedge_cancel = CancelToken()
+                hedge = hedge_executor.submit(
+                    run_attempt, send, balancer, hedge_endpoint, controller, hedge_cancel
+                )
+                copies[hedge] = ("hedge", hedge_endpoint.api_base, hedge_cancel)
+
+    last_error: Optional[DetectionError] = None
+    pending = set(copies)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            role, api_base, _ = copies[future]
+            try:
+                body = future.result()
+            except DetectionError as exc:
+                last_error = exc
+                continue
+            for other in pending:
+                copies[other][2].set()
+            hedge_policy.record_latency(time.perf_counter() - primary_started)
+            hedge_policy.record_win(role == "hedge")
+            return body, api_base, {"hedged": len(copies) > 1, "winner": role}
+    assert last_error is not None
+    raise last_error
+
+
+def request_with_retries(
+    send: Callable[[str, Optional[CancelToken]], Dict[str, Any]],
+    balancer: EndpointBalancer,
+    retry_policy: Optional[RetryPolicy] = None,
+    controller: Optional[AdaptiveConcurrency] = None,
+    hedge_policy: Optional[HedgePolicy] = None,
+    hedge_executor: Optional[ThreadPoolExecutor] = None,
+) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Call ``send`` with a balanced endpoint until it succeeds or the retry policy gives up.
+
+    Returns the response body and one outcome entry per attempt. On final failure the
+    attempt log is attached to the raised DetectionError.
+    """
+    attempts: List[Dict[str, Any]] = []
+    if retry_policy is not None:
+        retry_policy.register_request()
+    if hedge_policy is not None:
+        hedge_policy.register_request()
+    while True:
+        start_time = time.perf_counter()
+        hedge_details: Dict[str, Any] = {}
+        try:
+            if hedge_policy is not None and hedge_executor is not None:
+                body, api_base, hedge_details = run_hedged_attempt(
+                    send, balancer, hedge_policy, hedge_executor, controller
+                )
+            else:
+                endpoint = balancer.acquire()
+                body = run_attempt(send, balancer, endpoint, controller)
+                api_base = endpoint.api_base
+        except DetectionError as exc:
+            elapsed = time.perf_counter() - start_time
+            outcome = describe_attempt(len(attempts) + 1, elapsed, exc, exc.endpoint)
+            attempts.append(outcome)
+            requeues = sum(1 for attempt in attempts if attempt.get("requeued"))
+            if (
+                is_retryable_error(exc)
+                and retry_policy is not None
+                and requeues < retry_policy.max_requeues
+                and balancer.breaker_open(exc.endpoint)
+            ):
+                # The endpoint's breaker opened; requeue without spending a retry.
+                outcome["requeued"] = True
+                continue
+            counted = sum(1 for attempt in attempts if not attempt.get("requeued"))
+            delay = retry_policy.next_delay(counted, exc) if retry_policy else None
+            if delay is None:
+                exc.attempts = attempts
+                raise
+            outcome["backoff_seconds"] = round(delay, 3)
+            if balancer.stopping.wait(delay):
+                stopped = DetectionError("Stopped while backing off for a retry.", kind="cancelled")
+                stopped.attempts = attempts
+                raise stopped from exc
+            continue
+        elapsed = time.perf_counter() - start_time
+        outcome = describe_attempt(len(attempts) + 1, elapsed, endpoint=api_base)
+        outcome.update(hedge_details)
+        attempts.append(outcome)
+        return body, attempts
+
+
+def run_stage(stats: PipelineStats, stage: str, function: Callable[..., Any], *args: Any) -> Any:
+    """Call ``function`` and charge its wall time to ``stage``."""
+    started = time.perf_counter()
+    try:
+        return function(*args)
+    finally:
+        stats.record_busy(stage, time.perf_counter() - started)
+
+
+def detect_single_image(
+    rel_path: str,
+    payload: bytearray,
+    balancer: EndpointBalancer,
+    timeout: float,
+    controller: Optional[AdaptiveConcurrency] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+    stream: bool = False,
+    stream_early_stop: bool = False,
+    hedge_policy: Optional[HedgePolicy] = None,
+    hedge_executor: Optional[ThreadPoolExecutor] = None,
+    cache: Optional[ResponseCache] = None,
+    escalation: Optional[TokenEscalation] = None,
+) -> Tuple[str, List[Dict[str, Any]], Dict[str, Any]]:
+    """Send stage: detect objects in one image from its prepared request body.
+
+    ``stream`` must match whether the body requests SSE. With an ``escalation``, a
+    generation truncated by ``max_tokens`` is re-issued at the next budget.
+    """
+
+    def send(api_base: str, cancel: Optional[CancelToken]) -> Dict[str, Any]:
+        if stream:
+            return request_completion_stream(
+                api_base,
+                payload,
+                timeout,
+                stop_at_array_end=stream_early_stop,
+                cancel=cancel,
+            )
+        return request_completion(api_base, payload, timeout)
+
+    attempts: List[Dict[str, Any]] = []
+    while True:
+        body, tries = request_with_retries(
+            send,
+            balancer,
+            retry_policy,
+            controller,
+            hedge_policy,
+            hedge_executor,
+        )
+        attempts.extend(tries)
+        try:
+            rel_path, detections, generation_record = build_detection_record(
+                rel_path, body, attempts[-1]["elapsed_seconds"]
+            )
+            break
+        except DetectionError as exc:
+            escalated = escalation.escalate(exc) if escalation is not None else None
+            if escalated is None:
+                exc.attempts = attempts
+                exc.token_budget = escalation.summary() if escalation is not None else None
+                raise
+            payload = escalated
+    generation_record["attempts"] = attempts
+    if escalation is not None:
+        escalation.finish(body)
+        if escalation.summary() is not None:
+            generation_record["token_budget"] = escalation.summary()
+        escalation.store(cache, body)
+    return rel_path, detections, generation_record
+
+
+def schedule_largest_first(
+    args: argparse.Namespace,
+    dataset_root: Path,
+    images: Iterable[Path],
+    processed_paths: Set[str],
+) -> Iterator[Path]:
+    """Collect the pending images and return them most expensive first.
+
+    Ordering needs the whole list, so dispatch only starts once the scan has finished.
+    """
+    if args.cost_history is not None:
+        model = CostModel.from_details(args.cost_history, args.cost_basis)
+    else:
+        model = CostModel(args.cost_basis)
+    pending: List[Tuple[str, Path]] = []
+    for path in images:
+        rel_path = path.relative_to(dataset_root).as_posix()
+        if rel_path not in processed_paths:
+            pending.append((rel_path, path))
+    ordered = model.order(pending)
+    with_history = sum(1 for rel_path, _ in pending if rel_path in model.history)
+    print(
+        f"Scheduled {len(ordered)} images largest first by {args.cost_basis}"
+        + (f" and latency history of {with_history}" if model.history else "")
+    )
+    return iter([path for _, path in ordered])
+
+
+def report_dataset(scan: "DatasetScan", work_queue: Optional[WorkQueue] = None) -> None:
+    if scan.count:
+        print(f"Discovered {scan.count} images.")
+    if work_queue is not None:
+        stats = work_queue.summary()
+        print(
+            f"Work queue: {stats['done']} done, {stats['failed']} failed, "
+            f"{stats['pending']} pending, {stats['leased']} leased by other workers. "
+            f"This worker claimed {stats['claimed']} ({stats['recovered']} from expired "
+            f"leases), completed {stats['completed']}, failed {stats['failed_here']}"
+            + (f", lost {stats['lost']} leases" if stats["lost"] else "")
+        )
+
+
+def print_run_summary(
+    processed_paths: Set[str],
+    balancer: EndpointBalancer,
+    controller: Optional[AdaptiveConcurrency] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+    hedge_policy: Optional[HedgePolicy] = None,
+    cache: Optional[ResponseCache] = None,
+    ladder: Optional[TokenLadder] = None,
+    pipeline: Optional[PipelineStats] = None,
+    writer: Optional[RecordWriter] = None,
+    progress: Optional[RunProgress] = None,
+) -> None:
+    print(f"Completed. Total processed images: {len(processed_paths)}")
+    if progress is not None and progress.done:
+        stats = progress.summary()
+        print(
+            f"Throughput: {stats['done']} images ({stats['failed']} failed) in "
+            f"{format_duration(stats['elapsed_seconds'])}; recent rate "
+            f"{stats['images_per_second']:.2f} images/s, {stats['tokens_per_second']:.0f} tokens/s"
+        )
+    print_http_session_stats()
+    print_image_transport_stats()
+    templates = list(ladder.templates.values()) if ladder is not None else []
+    renders = sum(template.renders for template in templates)
+    if renders:
+        peak_rss = peak_rss_bytes()
+        peak_str = f", peak RSS {peak_rss / 1e6:.0f} MB" if peak_rss is not None else ""
+        template = templates[0]
+        print(
+            f"Payload serialization: {renders} requests, "
+            f"{1000 * sum(item.render_seconds for item in templates) / renders:.1f} ms mean, "
+            f"{1000 * max(item.max_render_seconds for item in templates):.1f} ms max "
+            f"(shared prefix {len(template.prefix) + len(template.suffix)} bytes){peak_str}"
+        )
+    if ladder is not None and ladder.policy is not None:
+        stats = ladder.policy.summary()
+        print(
+            f"max_tokens ladder {ladder.policy.rungs}: {stats['escalations']} escalations, "
+            f"{stats['rescued']} truncated images rescued, {stats['exhausted']} still truncated "
+            f"at the ceiling; p{ladder.policy.percentile:g} completion "
+            f"{stats['completion_percentile']:.0f} tokens over {stats['samples']} samples, "
+            f"next start budget {ladder.policy.initial_budget()}"
+        )
+    if pipeline is not None:
+        stats = pipeline.summary()
+        utilization = stats["utilization"]
+        print(
+            f"Pipeline: prepare {utilization['prepare']:.0%} busy "
+            f"({pipeline.workers['prepare']} workers), send {utilization['send']:.0%} busy "
+            f"({pipeline.workers['send']} workers); ready queue depth "
+            f"{stats['mean_depth']:.1f} mean, {stats['max_depth']} max; "
+            f"send slots waited on preparation {stats['starved']} times"
+        )
+    if writer is not None and writer.flushes:
+        stats = writer.summary()
+        print(
+            f"Output writer: {stats['records']} records, {stats['bytes'] / 1e6:.1f} MB "
+            f"({stats['cot_bytes'] / 1e6:.1f} MB compressed CoT) in "
+            f"{stats['flushes']} flushes ({stats['fsyncs']} fsyncs, fsync={writer.fsync}), "
+            f"{stats['bytes_per_second'] / 1e3:.1f} kB/s, {stats['io_seconds']:.2f}s in file I/O"
+        )
+    if cache is not None and cache.enabled:
+        stats = cache.summary()
+        print(
+            f"Response cache ({stats['mode']}): {stats['hits']} hits, {stats['misses']} misses, "
+            f"{stats['stores']} stored, {stats['evictions']} evicted, "
+            f"{stats['size_bytes'] / 1e6:.1f} MB on disk"
+        )
+    if len(balancer.endpoints) > 1:
+        for stats in balancer.summary():
+            latency = stats["ewma_latency_seconds"]
+            latency_str = f"{latency:.2f}s" if latency is not None else "n/a"
+            print(
+                f"Endpoint {stats['api_base']}: {stats['requests']} requests, "
+                f"{stats['failures']} failures, {stats['ejections']} ejections, "
+                f"EWMA latency {latency_str}"
+            )
+    if retry_policy is not None and retry_policy.retries:
+        print(f"Retries: {retry_policy.retries} for {retry_policy.first_attempts} requests")
+    if hedge_policy is not None:
+        print(
+            f"Hedged requests: {hedge_policy.hedges} of {hedge_policy.requests} "
+            f"({hedge_policy.hedge_wins} won by the hedge)"
+        )
+    if controller is not None:
+        summary = controller.summary()
+        print(
+            f"Final concurrency limit: {summary['limit']} "
+            f"(p95 {summary['p95_seconds']:.1f}s, error rate {summary['error_rate']:.0%})"
         )
-    detections_to_use = sanitized if sanitized else detections
-    cot_text = metadata.get("cot_output") if isinstance(metadata, dict) else None
-    finish_reason = metadata.get("finish_reason") if isinstance(metadata, dict) else None
-    generation_record = {
-        "image": rel_path,
-        "elapsed_seconds": elapsed,
-        "assistant_text": raw_text,
-        "cot_text": cot_text,
-        "finish_reason": finish_reason,
-        "detections": detections_to_use,
-        "response": body,
-    }
-    return rel_path, detections_to_use, generation_record
 
 
 def main() -> None:
@@ -299,125 +1288,471 @@ def main() -> None:
     if not dataset_root.is_dir():
         raise FileNotFoundError(f"Dataset root not found or not a directory: {dataset_root}")
     args.dataset_root = dataset_root
+    if args.shard_count < 1 or not 0 <= args.shard_index < args.shard_count:
+        raise ValueError("--shard-index must be between 0 and --shard-count - 1.")
+    if args.prepare_workers < 1:
+        raise ValueError("--prepare-workers must be at least 1.")
+    if args.prefetch is not None and args.prefetch < 1:
+        raise ValueError("--prefetch must be at least 1.")
+    if args.time_budget is not None and args.time_budget <= 0:
+        raise ValueError("--time-budget must be a positive number of seconds.")
+    if args.deadline is not None and args.deadline <= time.time():
+        raise ValueError("--deadline is already in the past.")
+    deadlines = [args.deadline] if args.deadline is not None else []
+    if args.time_budget is not None:
+        deadlines.append(time.time() + args.time_budget)
+    deadline = min(deadlines) if deadlines else None
 
     extensions = normalize_extensions(args.extensions or DEFAULT_EXTENSIONS)
-    ensure_output_directory(args.results_path)
+    if args.plan and args.work_queue is not None:
+        raise ValueError("--plan reads the dataset directly; do not combine it with --work-queue.")
+    if not args.plan:
+        ensure_output_directory(args.results_path)
     details_path = args.generation_details_path or derive_details_path(args.results_path)
     arguments_path = args.generation_arguments_path or derive_arguments_path(args.results_path)
+    failures_path = args.failures_path or derive_failures_path(args.results_path)
+    if args.retry_failed and args.work_queue is not None:
+        raise ValueError(
+            "--retry-failed reads the failure ledger; do not combine it with --work-queue."
+        )
 
     argument_payload = serialize_args_for_json(args)
     argument_payload.update(
         {
             "generation_details_path": str(details_path),
+            "generation_cot_path": str(derive_cot_path(details_path)),
             "generation_arguments_path": str(arguments_path),
+            "failures_path": str(failures_path),
         }
     )
-    write_arguments_file(arguments_path, argument_payload)
+    if not args.plan:
+        write_arguments_file(arguments_path, argument_payload)
 
-    processed_records = load_existing_results(args.results_path) if args.resume else {}
-    processed_paths = set(processed_records.keys())
+    processed_paths = load_processed_paths(args.results_path) if args.resume else set()
+    open_failures = load_failures(failures_path)
 
-    images = find_images(dataset_root, extensions)
+    scan = DatasetScan(
+        dataset_root, extensions, args.file_list, args.refresh_file_list, record=not args.plan
+    )
+    source = f"file list {args.file_list}" if scan.uses_snapshot() else f"scan of {dataset_root}"
+    discovered: Iterator[Path] = iter(scan)
+    if args.shard_count > 1:
+        discovered = (
+            path
+            for path in discovered
+            if shard_of(path.relative_to(dataset_root).as_posix(), args.shard_count)
+            == args.shard_index
+        )
+        source += f" (shard {args.shard_index} of {args.shard_count})"
     if args.limit is not None:
-        images = images[: args.limit]
+        discovered = islice(discovered, args.limit)
+    if args.schedule == "largest-first" and not args.retry_failed:
+        discovered = schedule_largest_first(args, dataset_root, discovered, processed_paths)
+        source = f"{source}, largest first"
+    work_queue: Optional[WorkQueue] = None
+    if args.retry_failed:
+        # Only the ledger is read, so a retry pass costs O(failures) instead of a dataset walk.
+        if not open_failures:
+            print(f"No unresolved failures in {failures_path}.", file=sys.stderr)
+            return
+        retry_paths = [dataset_root / rel_path for rel_path in open_failures]
+        if args.limit is not None:
+            retry_paths = retry_paths[: args.limit]
+        images: Iterator[Path] = iter(retry_paths)
+        if args.schedule == "largest-first":
+            images = schedule_largest_first(args, dataset_root, images, processed_paths)
+        source = f"failure ledger {failures_path} ({len(retry_paths)} images)"
+    elif args.work_queue is not None:
+        work_queue = WorkQueue(args.work_queue, args.lease_seconds)
+        if work_queue.seeded():
+            source = f"work queue {args.work_queue}"
+        else:
+            work_queue.start_seeding(
+                (path.relative_to(dataset_root).as_posix() for path in discovered),
+                processed_paths,
+            )
+            source += f" through work queue {args.work_queue}"
+        images = work_queue.claims(
+            dataset_root, args.max_workers, processed_paths
+        )
+    else:
+        first_image = next(discovered, None)
+        if first_image is None:
+            print("No images found to process.", file=sys.stderr)
+            return
+        images = chain([first_image], discovered)
 
-    if not images:
-        print("No images found to process.", file=sys.stderr)
-        return
+    # Sorted and retried sources are lists; a scan is sized from its file-list snapshot.
+    expected = operator.length_hint(images) or None
+    if expected is None and work_queue is None and not args.retry_failed:
+        expected = scan.snapshot_size()
+        if expected is not None:
+            expected //= args.shard_count
+            if args.limit is not None:
+                expected = min(expected, args.limit)
+            expected = max(expected - len(processed_paths), 0)
 
-    print(f"Discovered {len(images)} images. Processed entries loaded: {len(processed_paths)}")
+    if args.plan:
+        print(f"Planning images from the {source}. Processed entries loaded: {len(processed_paths)}")
+    else:
+        print(
+            f"Dispatching images from the {source} as they are found. "
+            f"Processed entries loaded: {len(processed_paths)}"
+        )
 
-    lock = Lock()
-    details_lock = Lock()
     stop_requested = False
     example_specs = [
         (Path(image_path), Path(annotation_path))
         for image_path, annotation_path in (args.example or [])
     ]
     context_specs = [Path(path) for path in (args.context_image or [])]
-    example_payloads = load_example_pairs(example_specs) if example_specs else None
+    encoding = image_encoding_from_args(args)
+    example_payloads = (
+        load_example_pairs(example_specs, args.image_transport, encoding)
+        if example_specs
+        else None
+    )
     context_payloads = None
     if context_specs:
-        context_payloads = load_context_images(context_specs)
+        context_payloads = load_context_images(context_specs, args.image_transport, encoding)
     if example_payloads and context_payloads:
         raise ValueError("Specify either --example or --context-image, not both.")
 
+    if args.plan:
+        from batch_plan import run_plan
+
+        run_plan(
+            args,
+            images,
+            processed_paths,
+            build_payload_template(args, example_payloads, context_payloads),
+            [image_path for image_path, _ in example_specs] + context_specs,
+            encoding,
+        )
+        return
+
+    progress = RunProgress(expected, deadline)
+    pending_images = PendingImages(images, dataset_root, processed_paths, progress)
+    if deadline is not None:
+        print(
+            "Dispatching until "
+            f"{datetime.fromtimestamp(deadline).isoformat(sep=' ', timespec='seconds')}; "
+            "requests projected to finish later are left for --resume."
+        )
+    endpoints = resolve_endpoints(args)
+    configure_http_session(args.pool_size or args.max_workers, host_count=len(endpoints))
+
+    controller: Optional[AdaptiveConcurrency] = None
+    if args.adaptive_concurrency:
+        concurrency_log_path = args.concurrency_log_path or derive_concurrency_log_path(
+            args.results_path
+        )
+        controller = AdaptiveConcurrency(
+            minimum=min(args.min_workers, args.max_workers),
+            maximum=args.max_workers,
+            target_p95=args.target_p95 if args.target_p95 is not None else args.timeout / 2,
+            max_error_rate=args.max_error_rate,
+            log_path=concurrency_log_path,
+        )
+    balancer = EndpointBalancer(
+        endpoints,
+        strategy=args.balance,
+        eject_after=args.eject_after,
+        eject_seconds=args.eject_seconds,
+    )
+    if len(endpoints) > 1:
+        print(f"Balancing requests across {len(endpoints)} endpoints ({args.balance}).")
+    retry_policy = RetryPolicy(
+        max_retries=args.max_retries,
+        base_delay=args.retry_base_delay,
+        max_delay=args.retry_max_delay,
+        budget_ratio=args.retry_budget,
+        max_requeues=args.max_requeues,
+    )
+    hedge_policy: Optional[HedgePolicy] = None
+    if args.hedge_percentile is not None:
+        hedge_policy = HedgePolicy(
+            percentile=args.hedge_percentile,
+            max_ratio=args.hedge_max_ratio,
+            min_samples=args.hedge_min_samples,
+        )
+
+    cache = ResponseCache(
+        args.cache_path or derive_cache_path(args.results_path),
+        mode=args.cache_mode,
+        max_bytes=int(args.cache_max_mb * 1e6),
+    )
+    # A request is sent before it is known to need a hedge, and only a streamed copy can be
+    # aborted once the other wins, so the thread engine streams every request when hedging.
+    stream = args.stream or args.stream_early_stop
+    if args.engine == "threads" and hedge_policy is not None:
+        stream = True
+    token_policy: Optional[TokenBudgetPolicy] = None
+    if args.escalate_max_tokens:
+        token_policy = TokenBudgetPolicy(
+            args.max_tokens,
+            floor=args.min_max_tokens,
+            percentile=args.max_tokens_percentile,
+        )
+    ladder = TokenLadder(
+        lambda max_tokens: build_payload_template(
+            args, example_payloads, context_payloads, stream, max_tokens
+        ),
+        args.max_tokens,
+        token_policy,
+        cache.enabled,
+    )
+    writer = RecordWriter(
+        args.results_path,
+        details_path,
+        fsync=args.fsync,
+        flush_bytes=int(args.flush_kb * 1024),
+        flush_seconds=args.flush_interval,
+        details_level=args.details_level,
+        failures_path=failures_path,
+        open_failures=set(open_failures),
+    )
+
+    if args.engine == "asyncio":
+        from batch_async import run_async_batch
+
+        try:
+            asyncio.run(
+                run_async_batch(
+                    args,
+                    pending_images,
+                    processed_paths,
+                    writer,
+                    balancer,
+                    ladder,
+                    progress,
+                    controller,
+                    retry_policy,
+                    hedge_policy,
+                    cache,
+                    work_queue,
+                )
+            )
+        finally:
+            writer.close()
+            if work_queue is not None:
+                work_queue.close()
+        cache.close()
+        report_dataset(scan, work_queue)
+        print_run_summary(
+            processed_paths,
+            balancer,
+            controller,
+            retry_policy,
+            hedge_policy,
+            cache,
+            ladder,
+            writer=writer,
+            progress=progress,
+        )
+        report_early_stop(
+            derive_remaining_path(args.results_path),
+            progress,
+            pending_images,
+            processed_paths,
+            len(writer.open_failures),
+            work_queue,
+        )
+        return
+
     def signal_handler(signum: int, frame: Any) -> None:  # pragma: no cover - system integration
         nonlocal stop_requested
         stop_requested = True
+        progress.stop("signal")
+        balancer.stop()
         warn(f"Received signal {signum}; finishing in-progress tasks gracefully...")
 
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
+    hedge_executor: Optional[ThreadPoolExecutor] = None
+    if hedge_policy is not None:
+        # Each worker may have a primary and a hedged copy in flight at once.
+        hedge_executor = ThreadPoolExecutor(
+            max_workers=2 * args.max_workers, thread_name_prefix="hedge"
+        )
+
+    prober_stop = Event()
+    prober = Thread(
+        target=run_health_prober, args=(balancer, prober_stop), name="prober", daemon=True
+    )
+    prober.start()
+
+    pipeline = PipelineStats({"prepare": args.prepare_workers, "send": args.max_workers})
+    prefetch = args.prefetch if args.prefetch is not None else 2 * args.max_workers
+    preparer = ThreadPoolExecutor(max_workers=args.prepare_workers, thread_name_prefix="prepare")
+
     with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
         futures: Dict[Future[Tuple[str, List[Dict[str, Any]], Dict[str, Any]]], str] = {}
-        pending = deque(images)
+        # Requests being prepared ahead of a free send slot, in dataset order.
+        prepared: Deque[
+            Tuple[str, TokenEscalation, Future[Tuple[bytearray, Optional[str], Any]]]
+        ] = deque()
+        pending = iter(pending_images)
 
-        def submit_next() -> None:
-            while pending and len(futures) < args.max_workers and not stop_requested:
-                image_path = pending.popleft()
+        def dispatch_open() -> bool:
+            """False once a signal arrived or the deadline no longer admits new requests."""
+            nonlocal stop_requested
+            if not stop_requested and not progress.admits():
+                stop_requested = True
+                warn("Deadline reached for new requests; finishing in-progress tasks...")
+            return not stop_requested
+
+        def fill_prepared() -> None:
+            while len(prepared) < prefetch and dispatch_open():
+                image_path = next(pending, None)
+                if image_path is None:
+                    return
                 rel_path = image_path.relative_to(dataset_root).as_posix()
                 if rel_path in processed_paths:
                     continue
-                futures[executor.submit(
-                    detect_single_image,
-                    image_path,
-                    rel_path,
-                    args.prompt,
-                    args.model,
-                    args.temperature,
-                    args.top_p,
-                    args.top_k,
-                    args.repetition_penalty,
-                    args.presence_penalty,
-                    args.seed,
-                    args.max_tokens,
-                    args.api_base,
-                    args.timeout,
-                    example_payloads,
-                    context_payloads,
-                )] = rel_path
-
-        submit_next()
+                escalation = ladder.start(image_path, args.image_transport)
+                prepared.append((rel_path, escalation, preparer.submit(
+                    run_stage,
+                    pipeline,
+                    "prepare",
+                    prepare_request,
+                    escalation,
+                    cache,
+                )))
+
+        def write_success(
+            image_key: str, detections: List[Dict[str, Any]], generation_record: Dict[str, Any]
+        ) -> None:
+            writer.write_details(generation_record)
+            writer.write_result(
+                {"image": image_key, "detections": detections},
+                on_written=queue_completion(work_queue, image_key),
+            )
+            processed_paths.add(image_key)
+            progress.record(
+                request_seconds(generation_record.get("attempts")),
+                total_tokens(generation_record.get("response")),
+            )
+            print(f"Processed {image_key} ({len(detections)} detections) [{progress.status()}]")
+
+        def handle_outcome(rel_path: str, outcome: "Future[Any]", is_prepare: bool) -> None:
+            try:
+                result = outcome.result()
+                if is_prepare:
+                    write_success(*build_cached_record(rel_path, result[1]))
+                else:
+                    write_success(*result)
+            except DetectionError as exc:
+                if exc.kind == "cancelled":
+                    warn(f"Stopped before {rel_path} finished; --resume will send it again.")
+                    return
+                warn(f"Detection error for {rel_path}: {exc}")
+                progress.record(request_seconds(exc.attempts), failed=True)
+                writer.write_details(build_failure_record(rel_path, exc))
+                writer.write_failure(build_failure_entry(rel_path, exc))
+                if work_queue is not None:
+                    work_queue.fail(rel_path, str(exc))
+            except Exception as exc:
+                warn(f"Unexpected error for {rel_path}: {exc}")
+                progress.record(failed=True)
+                writer.write_failure(build_failure_entry(rel_path, exc))
+                if work_queue is not None:
+                    work_queue.fail(rel_path, str(exc))
+
+        def dispatch_ready() -> None:
+            limit = controller.limit if controller is not None else args.max_workers
+            while prepared and len(futures) < limit and dispatch_open():
+                rel_path, escalation, ready = prepared[0]
+                if not ready.done():
+                    pipeline.record_depth(0, starved=True)
+                    return
+                prepared.popleft()
+                pipeline.record_depth(sum(1 for _, _, item in prepared if item.done()) + 1)
+                if ready.exception() is not None or ready.result()[1] is not None:
+                    # Failed preparations and cache hits never need a send slot.
+                    handle_outcome(rel_path, ready, is_prepare=True)
+                else:
+                    body, _ = ready.result()
+                    futures[executor.submit(
+                        run_stage,
+                        pipeline,
+                        "send",
+                        detect_single_image,
+                        rel_path,
+                        body,
+                        balancer,
+                        args.timeout,
+                        controller,
+                        retry_policy,
+                        stream,
+                        args.stream_early_stop,
+                        hedge_policy,
+                        hedge_executor,
+                        cache,
+                        escalation,
+                    )] = rel_path
+                fill_prepared()
 
         try:
-            while futures:
-                for future in as_completed(list(futures.keys())):
-                    rel_path = futures.pop(future)
-                    try:
-                        image_key, detections, generation_record = future.result()
-                        record = {
-                            "image": image_key,
-                            "detections": detections,
-                        }
-                        append_result(args.results_path, lock, record)
-                        append_generation_details(details_path, details_lock, generation_record)
-                        processed_paths.add(image_key)
-                        print(f"Processed {image_key} ({len(detections)} detections)")
-                    except DetectionError as exc:
-                        warn(f"Detection error for {rel_path}: {exc}")
-                    except Exception as exc:
-                        warn(f"Unexpected error for {rel_path}: {exc}")
-                    if stop_requested:
-                        warn("Stopping submission of new tasks due to signal.")
-                    submit_next()
-                    if stop_requested and not futures:
-                        warn("All in-flight tasks completed after stop signal.")
-                        break
+            fill_prepared()
+            while True:
+                dispatch_ready()
+                waitables: Set["Future[Any]"] = set(futures)
+                limit = controller.limit if controller is not None else args.max_workers
+                if prepared and len(futures) < limit and not stop_requested:
+                    waitables.add(prepared[0][2])
+                if not waitables:
+                    break
+                done, _ = wait(waitables, return_when=FIRST_COMPLETED)
+                for future in done:
+                    rel_path = futures.pop(future, None)
+                    if rel_path is not None:
+                        handle_outcome(rel_path, future, is_prepare=False)
                 if stop_requested and not futures:
+                    warn(f"All in-flight tasks completed after {progress.stop_reason} stop.")
                     break
         finally:
+            for _, _, ready in prepared:
+                ready.cancel()
             for future in futures:
                 future.cancel()
+            preparer.shutdown(wait=True)
+            writer.close()
+            if work_queue is not None:
+                work_queue.close()
 
-    print(f"Completed. Total processed images: {len(processed_paths)}")
+    prober_stop.set()
+    if hedge_executor is not None:
+        hedge_executor.shutdown(wait=True)
+    cache.close()
+    report_dataset(scan, work_queue)
+    print_run_summary(
+        processed_paths,
+        balancer,
+        controller,
+        retry_policy,
+        hedge_policy,
+        cache,
+        ladder,
+        pipeline,
+        writer,
+        progress,
+    )
+    report_early_stop(
+        derive_remaining_path(args.results_path),
+        progress,
+        pending_images,
+        processed_paths,
+        len(writer.open_failures),
+        work_queue,
+    )
 
 
 if __name__ == "__main__":
     try:
         main()
-    except FileNotFoundError as exc:
+    except (FileNotFoundError, ImportError) as exc:
         print(f"Error: {exc}", file=sys.stderr)
         sys.exit(1)
     except KeyboardInterrupt:
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""Dry-run cost planning for batch_detect: token, payload and wall-time estimates, no requests."""
+
+import argparse
+import json
+import math
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from PIL import Image
+
+from batch_control import format_duration, percentile
+from query_bbox import (
+    ImageEncoding,
+    PayloadTemplate,
+    data_url_length,
+    estimate_vision_tokens,
+    warn,
+)
+
+# Rough text tokenization rate; conservative for English prompts and JSON annotations.
+CHARS_PER_TOKEN = 3.5
+# Chat-template tokens around each message (<|im_start|>role\n ... <|im_end|>\n).
+MESSAGE_OVERHEAD_TOKENS = 5
+# <|vision_start|> and <|vision_end|> around every image's patch tokens.
+VISION_MARKER_TOKENS = 2
+# How many over-length image names the report lists.
+_OVER_LENGTH_SHOWN = 10
+# Images actually re-encoded to calibrate the bytes per pixel of --transcode/downscale output.
+_ENCODE_SAMPLES = 16
+
+
+def estimate_text_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def image_tokens(size: Tuple[int, int], encoding: Optional[ImageEncoding] = None) -> int:
+    """Prompt tokens for one image of ``size`` after client-side downscaling, if any."""
+    if encoding is not None:
+        size = encoding.target_size(size)
+    return estimate_vision_tokens(size) + VISION_MARKER_TOKENS
+
+
+def template_prompt_tokens(
+    template: PayloadTemplate,
+    fixed_images: Sequence[Path],
+    encoding: Optional[ImageEncoding] = None,
+) -> int:
+    """Prompt tokens every request shares: messages, text and the example/context images."""
+    tokens = 0
+    for message in template.payload.get("messages", []):
+        tokens += MESSAGE_OVERHEAD_TOKENS
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += estimate_text_tokens(content)
+            continue
+        for part in content or []:
+            if isinstance(part.get("text"), str):
+                tokens += estimate_text_tokens(part["text"])
+    for path in fixed_images:
+        with Image.open(path) as image:
+            tokens += image_tokens(image.size, encoding)
+    return tokens
+
+
+def measured_throughput(details_path: Path) -> Dict[str, Any]:
+    """Tokens per second of one in-flight request, and mean completion length, from details.
+
+    Reads the token usage of successful, uncached requests in a generation-details JSONL
+    written with ``--details-level usage`` or ``full``.
+    """
+    tokens = 0
+    seconds = 0.0
+    completions: List[int] = []
+    with details_path.open("r", encoding="utf-8") as handle:
+        for line in handle:
+            try:
+                record = json.loads(line)
+                if record.get("cache") == "hit" or record.get("error"):
+                    continue
+                usage = record.get("usage")
+                if usage is None and isinstance(record.get("response"), dict):
+                    usage = record["response"].get("usage")
+                if not isinstance(usage, dict):
+                    continue
+                total = int(usage["prompt_tokens"]) + int(usage["completion_tokens"])
+                elapsed = float(record["elapsed_seconds"])
+            except (ValueError, KeyError, TypeError, AttributeError):
+                continue
+            if elapsed > 0:
+                tokens += total
+                seconds += elapsed
+                completions.append(int(usage["completion_tokens"]))
+    return {
+        "samples": len(completions),
+        "tokens_per_second": tokens / seconds if seconds else None,
+        "mean_completion_tokens": sum(completions) / len(completions) if completions else None,
+    }
+
+
+def unencoded_reference_bytes(path: Path, transport: str) -> int:
+    """Length of the image reference for a file sent as it is on disk."""
+    if transport == "file":
+        return len(json.dumps(path.resolve().as_uri())) - 2
+    return data_url_length(path)
+
+
+def run_plan(
+    args: argparse.Namespace,
+    images: Iterable[Path],
+    processed_paths: Set[str],
+    template: PayloadTemplate,
+    fixed_images: Sequence[Path],
+    encoding: Optional[ImageEncoding] = None,
+) -> None:
+    """Print what sending ``images`` would cost, reading only image headers and file sizes.
+
+    Every request is ``template`` with one target image, so its prompt is the shared
+    template tokens plus the image's vision tokens (after ``encoding``'s downscaling). A
+    request whose prompt plus ``--max-tokens`` exceeds ``--max-model-len`` is flagged.
+    Images ``encoding`` would re-encode are identified from their headers; the first few
+    are encoded for real and the rest extrapolated from their bytes per sent pixel.
+    Wall time is projected from ``--plan-tokens-per-second`` (aggregate across workers) or
+    from the per-request rate measured in ``--cost-history`` times ``--max-workers``.
+    """
+    shared_tokens = template_prompt_tokens(template, fixed_images, encoding)
+    shared_bytes = len(template.prefix) + len(template.suffix) + 2
+    vision: List[int] = []
+    payload_bytes = 0
+    samples = 0
+    sampled_bytes = 0
+    sampled_pixels = 0
+    extrapolated_pixels = 0
+    extrapolated = 0
+    skipped = 0
+    unreadable = 0
+    over_length: List[str] = []
+    for path in images:
+        rel_path = path.relative_to(args.dataset_root).as_posix()
+        if rel_path in processed_paths:
+            skipped += 1
+            continue
+        try:
+            with Image.open(path) as image:
+                size = image.size
+                source_format = image.format
+            sent_size = encoding.target_size(size) if encoding is not None else size
+            sent_pixels = sent_size[0] * sent_size[1]
+            reference_bytes = 0
+            if encoding is None or not encoding.needs_encoding(
+                size, source_format, path.stat().st_size
+            ):
+                reference_bytes = unencoded_reference_bytes(path, args.image_transport)
+            elif samples < _ENCODE_SAMPLES:
+                prepared = encoding.prepare(path)
+                if prepared.data is None:
+                    reference_bytes = unencoded_reference_bytes(path, args.image_transport)
+                else:
+                    reference_bytes = len(
+                        f"data:{prepared.mime_type};base64,"
+                    ) + 4 * ((len(prepared.data) + 2) // 3)
+                samples += 1
+                sampled_bytes += reference_bytes
+                sampled_pixels += sent_pixels
+            else:
+                extrapolated += 1
+                extrapolated_pixels += sent_pixels
+        except (OSError, ValueError) as exc:
+            warn(f"Could not read {rel_path} for planning: {exc}")
+            unreadable += 1
+            continue
+        tokens = image_tokens(sent_size)
+        vision.append(tokens)
+        payload_bytes += shared_bytes + reference_bytes
+        if shared_tokens + tokens + args.max_tokens > args.max_model_len:
+            over_length.append(rel_path)
+
+    count = len(vision)
+    print(f"Plan: {count} images to send ({skipped} already processed, {unreadable} unreadable).")
+    if not count:
+        return
+    if extrapolated:
+        payload_bytes += int(extrapolated_pixels * sampled_bytes / sampled_pixels)
+    prompt_tokens = shared_tokens * count + sum(vision)
+    print(
+        f"Vision tokens per image: min {min(vision)}, mean {sum(vision) / count:.0f}, "
+        f"p95 {percentile(vision, 0.95):.0f}, max {max(vision)}"
+    )
+    print(
+        f"Prompt tokens: {shared_tokens} shared per request, {prompt_tokens} in total "
+        f"({prompt_tokens / count:.0f} per request)"
+    )
+    print(
+        f"Request payloads: {payload_bytes / 1e6:.1f} MB in total, "
+        f"{payload_bytes / count / 1e3:.1f} KB per request"
+        + (
+            f" ({extrapolated} re-encoded images extrapolated from a sample)"
+            if extrapolated
+            else ""
+        )
+    )
+    if over_length:
+        shown = ", ".join(over_length[:_OVER_LENGTH_SHOWN])
+        more = len(over_length) - _OVER_LENGTH_SHOWN
+        print(
+            f"Over length: {len(over_length)} requests exceed --max-model-len "
+            f"{args.max_model_len} with --max-tokens {args.max_tokens}: {shown}"
+            + (f" and {more} more" if more > 0 else "")
+        )
+
+    measured: Dict[str, Any] = {"samples": 0}
+    if args.cost_history is not None:
+        measured = measured_throughput(args.cost_history)
+    completion = measured.get("mean_completion_tokens")
+    if completion is None:
+        completion = args.max_tokens
+        completion_source = "--max-tokens, an upper bound"
+    else:
+        completion_source = f"mean of {measured['samples']} earlier requests"
+    total_tokens = prompt_tokens + completion * count
+    print(
+        f"Completion tokens: {completion:.0f} per request ({completion_source}); "
+        f"{total_tokens:.0f} tokens in total"
+    )
+    if args.plan_tokens_per_second is not None:
+        rate = args.plan_tokens_per_second
+        rate_source = "--plan-tokens-per-second"
+    elif measured.get("tokens_per_second") is not None:
+        rate = measured["tokens_per_second"] * args.max_workers
+        rate_source = (
+            f"{measured['tokens_per_second']:.0f} tokens/s per request measured in "
+            f"{args.cost_history} x {args.max_workers} workers"
+        )
+    else:
+        print(
+            "Wall time: unknown; pass --plan-tokens-per-second or a --cost-history with "
+            "token usage."
+        )
+        return
+    print(
+        f"Wall time: about {format_duration(total_tokens / rate)} at {rate:.0f} tokens/s "
+        f"({rate_source})"
+    )
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""Merge the outputs of sharded batch_detect runs into one results (and details) file."""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Sequence, Tuple
+
+from batch_detect import (
+    DEFAULT_EXTENSIONS,
+    DatasetScan,
+    derive_details_path,
+    normalize_extensions,
+    record_key,
+)
+from query_bbox import warn
+from record_writer import derive_cot_path
+
+# Where the latest record for an image lives: (source index, byte offset, byte length).
+Location = Tuple[int, int, int]
+
+
+def index_records(paths: Sequence[Path]) -> Tuple[Dict[str, Location], int]:
+    """Map each image key to its last record across ``paths``; also count superseded ones."""
+    index: Dict[str, Location] = {}
+    duplicates = 0
+    for source, path in enumerate(paths):
+        with path.open("rb") as handle:
+            offset = 0
+            for line_number, line in enumerate(handle, 1):
+                if line.strip():
+                    try:
+                        key = record_key(line)
+                    except ValueError as exc:
+                        warn(f"Skipping malformed record at {path}:{line_number}: {exc}")
+                    else:
+                        duplicates += key in index
+                        index[key] = (source, offset, len(line))
+                offset += len(line)
+    return index, duplicates
+
+
+class ShardMerger:
+    """Copy records in scan order from open shard files into one output file.
+
+    Details records that reference a chain-of-thought in their shard's ``.cot.gz`` stream
+    get the compressed member copied into the merged stream and their offset rewritten.
+    """
+
+    def __init__(self, sources: Sequence[Path], destination: Path, details: bool = False) -> None:
+        self.index, self.duplicates = index_records(sources)
+        self.handles: List[BinaryIO] = [path.open("rb") for path in sources]
+        self.output = destination.open("wb")
+        self.written = 0
+        self.cot_handles: List[Optional[BinaryIO]] = []
+        self.cot_output: Optional[BinaryIO] = None
+        if details:
+            for path in sources:
+                cot_path = derive_cot_path(path)
+                self.cot_handles.append(cot_path.open("rb") if cot_path.exists() else None)
+            if any(handle is not None for handle in self.cot_handles):
+                self.cot_output = derive_cot_path(destination).open("wb")
+
+    def copy(self, key: str) -> None:
+        location = self.index.pop(key, None)
+        if location is None:
+            return
+        source, offset, length = location
+        handle = self.handles[source]
+        handle.seek(offset)
+        line = handle.read(length)
+        if not line.endswith(b"\n"):
+            line += b"\n"
+        if self.cot_output is not None and b'"cot":{' in line:
+            line = self._move_cot(source, line)
+        self.output.write(line)
+        self.written += 1
+
+    def _move_cot(self, source: int, line: bytes) -> bytes:
+        record = json.loads(line)
+        reference = record.get("cot")
+        cot_handle = self.cot_handles[source]
+        if not isinstance(reference, dict) or cot_handle is None or self.cot_output is None:
+            return line
+        cot_handle.seek(reference["offset"])
+        record["cot"] = {"offset": self.cot_output.tell(), "length": reference["length"]}
+        self.cot_output.write(cot_handle.read(reference["length"]))
+        encoded = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        return (encoded + "\n").encode("utf-8")
+
+    def close(self) -> None:
+        for handle in [*self.handles, *self.cot_handles, self.output, self.cot_output]:
+            if handle is not None:
+                handle.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Combine batch_detect shard outputs (--shard-index/--shard-count) into one "
+            "deduplicated results file ordered like a scan of the dataset. Generation details "
+            "next to each shard's results are merged the same way."
+        )
+    )
+    parser.add_argument("dataset_root", type=Path, help="Dataset directory the shards scanned.")
+    parser.add_argument("output_path", type=Path, help="Merged results JSONL to write.")
+    parser.add_argument("shard_results", type=Path, nargs="+", help="Results JSONL of each shard.")
+    parser.add_argument(
+        "--extensions",
+        nargs="*",
+        help="Image extensions the shards used (default matches batch_detect.py).",
+    )
+    parser.add_argument(
+        "--file-list",
+        type=Path,
+        help="File-list snapshot to take the order from instead of walking the dataset.",
+    )
+    parser.add_argument(
+        "--no-details",
+        action="store_true",
+        help="Only merge results; skip the generation details files.",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    dataset_root = args.dataset_root.resolve()
+    if not dataset_root.is_dir():
+        raise FileNotFoundError(f"Dataset root not found or not a directory: {dataset_root}")
+    for path in args.shard_results:
+        if not path.is_file():
+            raise FileNotFoundError(f"Shard results not found: {path}")
+    if args.output_path.resolve() in {path.resolve() for path in args.shard_results}:
+        raise ValueError("The merged output must not overwrite one of the shard files.")
+
+    args.output_path.parent.mkdir(parents=True, exist_ok=True)
+    mergers = [ShardMerger(args.shard_results, args.output_path)]
+    if not args.no_details:
+        details_paths = [derive_details_path(path) for path in args.shard_results]
+        details_paths = [path for path in details_paths if path.is_file()]
+        if details_paths:
+            mergers.append(
+                ShardMerger(details_paths, derive_details_path(args.output_path), details=True)
+            )
+
+    extensions = normalize_extensions(args.extensions or DEFAULT_EXTENSIONS)
+    try:
+        for image_path in DatasetScan(dataset_root, extensions, args.file_list):
+            key = image_path.relative_to(dataset_root).as_posix()
+            for merger in mergers:
+                merger.copy(key)
+        for merger in mergers:
+            if merger.index:
+                warn(
+                    f"{len(merger.index)} records name images outside the scan; "
+                    "appending them in sorted order."
+                )
+                for key in sorted(merger.index):
+                    merger.copy(key)
+    finally:
+        for merger in mergers:
+            merger.close()
+
+    results = mergers[0]
+    print(
+        f"Merged {results.written} results from {len(args.shard_results)} shards into "
+        f"{args.output_path} ({results.duplicates} duplicates dropped)"
+    )
+    if len(mergers) > 1:
+        print(
+            f"Merged {mergers[1].written} generation details into "
+            f"{derive_details_path(args.output_path)}"
+        )
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except (FileNotFoundError, ValueError) as exc:
+        print(f"Error: {exc}", file=sys.stderr)
+        sys.exit(1)
@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
 import argparse
 import base64
+import io
 import json
+import math
 import mimetypes
+import socket
 import sys
 import time
+from dataclasses import dataclass
 from json import JSONDecodeError
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+from threading import Event, Lock
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 import requests
 from functools import lru_cache
+from requests.adapters import HTTPAdapter
 
 from PIL import Image, ImageDraw, ImageFont
 
@@ -26,18 +32,63 @@ SYSTEM_PROMPT = (
 
 
 REQUEST_TIMEOUT_DEFAULT = 120.0
+HTTP_POOL_SIZE_DEFAULT = 10
+HEALTH_PROBE_TIMEOUT = 5.0
+IMAGE_TRANSPORTS = ("base64", "file")
+IMAGE_PLACEHOLDER = "\x00target-image\x00"
+# Multiple of 3 so that chunk-wise base64 output concatenates into one valid encoding.
+_BASE64_CHUNK_SIZE = 3 * 256 * 1024
+# Qwen3-VL encodes 16x16 pixel patches and merges 2x2 of them into one visual token.
+VISION_TOKEN_PIXELS = 32
+# Pixel bounds the Qwen3-VL image processor resizes every image into (shortest/longest_edge).
+VISION_MIN_PIXELS = 64 * VISION_TOKEN_PIXELS * VISION_TOKEN_PIXELS
+VISION_MAX_PIXELS = 16384 * VISION_TOKEN_PIXELS * VISION_TOKEN_PIXELS
+TRANSCODE_FORMATS = {"jpeg": "JPEG", "webp": "WEBP"}
+OUTPUT_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+_http_session: Optional[requests.Session] = None
+_http_session_lock = Lock()
+_transport_stats = {
+    "images": 0,
+    "sent_bytes": 0,
+    "base64_bytes": 0,
+    "measured": 0,
+    "resized": 0,
+    "tokens_before": 0,
+    "tokens_after": 0,
+}
+# Per source extension: [images, bytes on disk, image bytes sent] for images run through an
+# ImageEncoding.
+_format_stats: Dict[str, List[int]] = {}
+_transport_stats_lock = Lock()
 
 
 class DetectionError(Exception):
-    """Raised when the model call fails or returns unusable data."""
+    """Raised when the model call fails or returns unusable data.
+
+    ``kind`` tells callers where the failure happened: ``"timeout"`` and ``"transport"`` for
+    requests that never produced a response, ``"http"`` for non-2xx responses (with
+    ``status_code`` set), ``"length"`` for generations cut off by ``max_tokens`` and
+    ``"response"`` for bodies that could not be turned into detections, and ``"cancelled"``
+    for requests abandoned by the caller. Callers that retry record the outcome of every try
+    in ``attempts``, the endpoint that failed in ``endpoint`` and any ``max_tokens``
+    escalation in ``token_budget``.
+    """
 
     def __init__(
         self,
         message: str,
         generation_details: Optional[Dict[str, Any]] = None,
+        kind: str = "response",
+        status_code: Optional[int] = None,
     ) -> None:
         super().__init__(message)
         self.generation_details = generation_details
+        self.kind = kind
+        self.status_code = status_code
+        self.attempts: List[Dict[str, Any]] = []
+        self.endpoint: Optional[str] = None
+        self.token_budget: Optional[Dict[str, Any]] = None
 
 
 def warn(message: str) -> None:
@@ -130,6 +181,30 @@ def parse_args() -> argparse.Namespace:
         default=REQUEST_TIMEOUT_DEFAULT,
         help="Request timeout in seconds for the model API.",
     )
+    parser.add_argument(
+        "--image-transport",
+        choices=IMAGE_TRANSPORTS,
+        default="base64",
+        help=(
+            "How images reach the server: inline base64 data URLs, or file:// paths for a vLLM "
+            "server started with --allowed-local-media-path on the same filesystem "
+            "(default: %(default)s)."
+        ),
+    )
+    add_image_encoding_arguments(parser)
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help=(
+            "Stream the completion and print detections as they arrive, along with time to "
+            "first token and inter-token latency."
+        ),
+    )
+    parser.add_argument(
+        "--stream-early-stop",
+        action="store_true",
+        help="With --stream, close the connection as soon as the detection array is complete.",
+    )
     parser.add_argument(
         "--save-path",
         type=Path,
@@ -166,7 +241,12 @@ def parse_args() -> argparse.Namespace:
     return parser.parse_args()
 
 
-def encode_image(image_path: Path) -> str:
+def encode_image(image_path: Path, encoding: Optional["ImageEncoding"] = None) -> str:
+    prepared = encoding.prepare(image_path) if encoding is not None else None
+    if prepared is not None and prepared.data is not None:
+        encoded = base64.b64encode(prepared.data).decode("utf-8")
+        return f"data:{prepared.mime_type};base64,{encoded}"
+
     mime_type, _ = mimetypes.guess_type(image_path.name)
     if not mime_type:
         raise ValueError(f"Unable to determine MIME type for {image_path}")
@@ -176,6 +256,279 @@ def encode_image(image_path: Path) -> str:
     return f"data:{mime_type};base64,{encoded}"
 
 
+def data_url_length(image_path: Path) -> int:
+    """Length of the base64 data URL ``encode_image`` would build, without reading the file."""
+    mime_type, _ = mimetypes.guess_type(image_path.name)
+    prefix = f"data:{mime_type or 'application/octet-stream'};base64,"
+    return len(prefix) + 4 * ((image_path.stat().st_size + 2) // 3)
+
+
+def vision_input_size(
+    size: Tuple[int, int],
+    min_pixels: int = VISION_MIN_PIXELS,
+    max_pixels: int = VISION_MAX_PIXELS,
+) -> Tuple[int, int]:
+    """Size the Qwen3-VL processor resizes ``size`` to (its ``smart_resize``).
+
+    Both sides are rounded to multiples of ``VISION_TOKEN_PIXELS``, then scaled with the
+    aspect ratio kept until the area lies within ``min_pixels``..``max_pixels``.
+    """
+    factor = VISION_TOKEN_PIXELS
+    width, height = size
+    resized_width = max(factor, round(width / factor) * factor)
+    resized_height = max(factor, round(height / factor) * factor)
+    if resized_width * resized_height > max_pixels:
+        beta = math.sqrt(width * height / max_pixels)
+        resized_width = max(factor, math.floor(width / beta / factor) * factor)
+        resized_height = max(factor, math.floor(height / beta / factor) * factor)
+    elif resized_width * resized_height < min_pixels:
+        beta = math.sqrt(min_pixels / (width * height))
+        resized_width = math.ceil(width * beta / factor) * factor
+        resized_height = math.ceil(height * beta / factor) * factor
+    return resized_width, resized_height
+
+
+def estimate_vision_tokens(
+    size: Tuple[int, int],
+    min_pixels: int = VISION_MIN_PIXELS,
+    max_pixels: int = VISION_MAX_PIXELS,
+) -> int:
+    """Qwen3-VL visual token count for an image of ``size`` pixels, excluding its markers."""
+    width, height = vision_input_size(size, min_pixels, max_pixels)
+    return (width // VISION_TOKEN_PIXELS) * (height // VISION_TOKEN_PIXELS)
+
+
+@dataclass
+class PreparedImage:
+    """Result of ``ImageEncoding.prepare``; ``data`` is None when the file is sent unchanged."""
+
+    data: Optional[bytes]
+    mime_type: str
+    original_size: Tuple[int, int]
+    sent_size: Tuple[int, int]
+
+
+class ImageEncoding:
+    """Client-side preparation of images before upload: downscaling and transcoding.
+
+    Images above ``max_pixels`` or ``max_side`` are shrunk with their aspect ratio kept, so
+    the model's 0-1000 normalized boxes mean the same thing on the original. JPEGs are
+    decoded in draft mode directly at a reduced DCT scale before the final bilinear resize.
+
+    With ``target_format`` (``jpeg`` or ``webp``) heavy formats such as BMP, GIF and PNG
+    are re-encoded at ``quality``. JPEGs up to ``passthrough_bytes`` and files already in
+    the target format skip decoding entirely; larger JPEGs are recompressed. A transcode
+    that comes out larger than the file on disk is discarded in favour of the original.
+    """
+
+    def __init__(
+        self,
+        max_pixels: Optional[int] = None,
+        max_side: Optional[int] = None,
+        target_format: Optional[str] = None,
+        quality: int = 90,
+        passthrough_bytes: int = 512 * 1024,
+    ) -> None:
+        self.max_pixels = max_pixels
+        self.max_side = max_side
+        self.target_format = target_format
+        self.quality = quality
+        self.passthrough_bytes = passthrough_bytes
+
+    def target_size(self, size: Tuple[int, int]) -> Tuple[int, int]:
+        width, height = size
+        scale = 1.0
+        if self.max_pixels:
+            scale = min(scale, math.sqrt(self.max_pixels / (width * height)))
+        if self.max_side:
+            scale = min(scale, self.max_side / max(width, height))
+        if scale >= 1.0:
+            return size
+        return max(1, int(width * scale)), max(1, int(height * scale))
+
+    def _should_transcode(self, source_format: Optional[str], file_size: int) -> bool:
+        if self.target_format is None:
+            return False
+        if source_format == "JPEG":
+            return file_size > self.passthrough_bytes
+        return source_format != TRANSCODE_FORMATS[self.target_format]
+
+    def needs_encoding(
+        self, size: Tuple[int, int], source_format: Optional[str], file_size: int
+    ) -> bool:
+        """Whether ``prepare`` decodes and re-encodes an image, judged from its header."""
+        return self.target_size(size) != size or self._should_transcode(source_format, file_size)
+
+    def prepare(self, image_path: Path) -> PreparedImage:
+        file_size = image_path.stat().st_size
+        with Image.open(image_path) as image:
+            original_size = image.size
+            source_format = image.format
+            mime_type = Image.MIME.get(source_format or "", "application/octet-stream")
+            target = self.target_size(original_size)
+            resize = target != original_size
+            if not self.needs_encoding(original_size, source_format, file_size):
+                return PreparedImage(None, mime_type, original_size, original_size)
+
+            exif = image.info.get("exif")
+            if source_format == "JPEG" and resize:
+                image.draft("RGB", target)
+            if image.mode in ("P", "1"):
+                image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+            if resize:
+                image = image.resize(target, Image.BILINEAR, reducing_gap=2.0)
+            else:
+                image.load()
+
+        if self.target_format is not None:
+            output_format = TRANSCODE_FORMATS[self.target_format]
+        else:
+            output_format = "JPEG" if source_format == "JPEG" else "PNG"
+        if output_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        save_options: Dict[str, Any] = {"exif": exif} if exif else {}
+        if output_format in ("JPEG", "WEBP"):
+            save_options["quality"] = self.quality
+        buffer = io.BytesIO()
+        image.save(buffer, format=output_format, **save_options)
+        data = buffer.getvalue()
+        if not resize and len(data) >= file_size:
+            return PreparedImage(None, mime_type, original_size, original_size)
+        return PreparedImage(data, OUTPUT_MIME_TYPES[output_format], original_size, target)
+
+
+def image_encoding_from_args(args: argparse.Namespace) -> Optional[ImageEncoding]:
+    if args.max_pixels is None and args.max_side is None and args.transcode is None:
+        return None
+    return ImageEncoding(
+        max_pixels=args.max_pixels,
+        max_side=args.max_side,
+        target_format=args.transcode,
+        quality=args.transcode_quality,
+        passthrough_bytes=int(args.passthrough_max_kb * 1024),
+    )
+
+
+def add_image_encoding_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--max-pixels",
+        type=int,
+        help=(
+            "Downscale images above this many pixels before upload, keeping the aspect ratio "
+            "(returned boxes are normalized, so their meaning is unchanged)."
+        ),
+    )
+    parser.add_argument(
+        "--max-side",
+        type=int,
+        help="Downscale images whose longer side exceeds this many pixels before upload.",
+    )
+    parser.add_argument(
+        "--transcode",
+        choices=sorted(TRANSCODE_FORMATS),
+        help="Re-encode heavy formats (BMP, GIF, PNG, large JPEGs) to this format for upload.",
+    )
+    parser.add_argument(
+        "--transcode-quality",
+        type=int,
+        default=90,
+        help="JPEG/WebP quality for --transcode and downscaled images (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--passthrough-max-kb",
+        type=float,
+        default=512.0,
+        help=(
+            "With --transcode, JPEGs up to this size are sent untouched without decoding "
+            "(default: %(default)s)."
+        ),
+    )
+
+
+def image_reference(
+    image_path: Path, transport: str = "base64", encoding: Optional[ImageEncoding] = None
+) -> str:
+    """Return the ``image_url`` for ``image_path`` using the requested transport.
+
+    ``base64`` inlines the file as a data URL. ``file`` sends an absolute ``file://`` URL
+    instead; the vLLM server must be able to read that path (start it with
+    ``--allowed-local-media-path`` covering the images). Images that ``encoding`` has to
+    downscale are always inlined, since the server would otherwise read the original.
+    """
+    if transport not in IMAGE_TRANSPORTS:
+        raise ValueError(f"Unknown image transport: {transport}")
+    prepared = encoding.prepare(image_path) if encoding is not None else None
+    if prepared is not None and prepared.data is not None:
+        encoded = base64.b64encode(prepared.data).decode("utf-8")
+        reference = f"data:{prepared.mime_type};base64,{encoded}"
+    elif transport == "file":
+        if not image_path.is_file():
+            raise FileNotFoundError(f"Image not found: {image_path}")
+        reference = image_path.resolve().as_uri()
+    else:
+        reference = encode_image(image_path)
+    _record_transport(image_path, len(reference), prepared)
+    return reference
+
+
+def _record_transport(
+    image_path: Path, sent_bytes: int, prepared: Optional[PreparedImage] = None
+) -> None:
+    base64_bytes = data_url_length(image_path)
+    with _transport_stats_lock:
+        _transport_stats["images"] += 1
+        _transport_stats["sent_bytes"] += sent_bytes
+        _transport_stats["base64_bytes"] += base64_bytes
+        if prepared is not None:
+            _transport_stats["measured"] += 1
+            _transport_stats["resized"] += prepared.sent_size != prepared.original_size
+            _transport_stats["tokens_before"] += estimate_vision_tokens(prepared.original_size)
+            _transport_stats["tokens_after"] += estimate_vision_tokens(prepared.sent_size)
+            disk_bytes = image_path.stat().st_size
+            counts = _format_stats.setdefault(image_path.suffix.lower() or "(none)", [0, 0, 0])
+            counts[0] += 1
+            counts[1] += disk_bytes
+            counts[2] += len(prepared.data) if prepared.data is not None else disk_bytes
+
+
+def image_transport_stats() -> Dict[str, int]:
+    """Bytes of image references sent so far, and what base64 data URLs would have cost.
+
+    ``tokens_before``/``tokens_after`` estimate vision tokens over the ``measured`` images
+    that went through an ``ImageEncoding``.
+    """
+    with _transport_stats_lock:
+        stats = dict(_transport_stats)
+    stats["saved_bytes"] = stats["base64_bytes"] - stats["sent_bytes"]
+    return stats
+
+
+def print_image_transport_stats() -> None:
+    stats = image_transport_stats()
+    if not stats["images"]:
+        return
+    if stats["saved_bytes"]:
+        print(
+            f"Image transport: {stats['images']} images sent as {stats['sent_bytes']} bytes, "
+            f"saving {stats['saved_bytes']} bytes over base64 of the original files "
+            f"({stats['saved_bytes'] / stats['base64_bytes']:.1%})"
+        )
+    if stats["resized"]:
+        print(
+            f"Image downscaling: {stats['resized']} of {stats['measured']} images resized; "
+            f"estimated vision tokens per image {stats['tokens_before'] / stats['measured']:.0f} "
+            f"-> {stats['tokens_after'] / stats['measured']:.0f}"
+        )
+    with _transport_stats_lock:
+        formats = {suffix: list(counts) for suffix, counts in _format_stats.items()}
+    for suffix, (images, disk_bytes, sent_bytes) in sorted(formats.items()):
+        reduction = 1 - sent_bytes / disk_bytes if disk_bytes else 0.0
+        print(
+            f"  {suffix}: {images} images, {disk_bytes} bytes on disk -> {sent_bytes} bytes "
+            f"encoded ({reduction:.1%} smaller)"
+        )
+
+
 def build_payload(
     prompt: str,
     image_data: str,
@@ -268,6 +621,81 @@ def build_payload(
     }
 
 
+class PayloadTemplate:
+    """A request body serialized once, with only the target image spliced in per request.
+
+    Build ``payload`` with ``IMAGE_PLACEHOLDER`` as the image; the system prompt, few-shot
+    examples, context images and decoding options around it are encoded to bytes a single
+    time. ``render`` streams the target file through base64 directly into the body, so
+    the raw file, its base64 string and a JSON copy are never held at once. Targets are
+    prepared with ``image_encoding`` when one is given.
+    """
+
+    def __init__(
+        self, payload: Dict[str, Any], image_encoding: Optional[ImageEncoding] = None
+    ) -> None:
+        self.payload = payload
+        self.image_encoding = image_encoding
+        encoded = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+        marker = json.dumps(IMAGE_PLACEHOLDER).encode("utf-8")
+        if encoded.count(marker) != 1:
+            raise ValueError("Payload template must reference IMAGE_PLACEHOLDER exactly once.")
+        self.prefix, self.suffix = encoded.split(marker)
+        self.renders = 0
+        self.render_seconds = 0.0
+        self.max_render_seconds = 0.0
+        self._lock = Lock()
+
+    def render(
+        self, image_path: Path, transport: str = "base64", digest: Optional[Any] = None
+    ) -> bytearray:
+        """Return the JSON request body for ``image_path``.
+
+        ``digest`` (a ``hashlib`` object) is fed the image bytes that are actually sent.
+        """
+        if transport not in IMAGE_TRANSPORTS:
+            raise ValueError(f"Unknown image transport: {transport}")
+        started = time.perf_counter()
+        prepared = None
+        if self.image_encoding is not None:
+            prepared = self.image_encoding.prepare(image_path)
+        body = bytearray(self.prefix)
+        body += b'"'
+        start = len(body)
+        if prepared is not None and prepared.data is not None:
+            body += f"data:{prepared.mime_type};base64,".encode("ascii")
+            body += base64.b64encode(prepared.data)
+            if digest is not None:
+                digest.update(prepared.data)
+        elif transport == "file":
+            if not image_path.is_file():
+                raise FileNotFoundError(f"Image not found: {image_path}")
+            body += json.dumps(image_path.resolve().as_uri())[1:-1].encode("utf-8")
+            if digest is not None:
+                with image_path.open("rb") as handle:
+                    for chunk in iter(lambda: handle.read(_BASE64_CHUNK_SIZE), b""):
+                        digest.update(chunk)
+        else:
+            mime_type, _ = mimetypes.guess_type(image_path.name)
+            if not mime_type:
+                raise ValueError(f"Unable to determine MIME type for {image_path}")
+            body += f"data:{mime_type};base64,".encode("ascii")
+            with image_path.open("rb") as handle:
+                for chunk in iter(lambda: handle.read(_BASE64_CHUNK_SIZE), b""):
+                    if digest is not None:
+                        digest.update(chunk)
+                    body += base64.b64encode(chunk)
+        _record_transport(image_path, len(body) - start, prepared)
+        body += b'"'
+        body += self.suffix
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.renders += 1
+            self.render_seconds += elapsed
+            self.max_render_seconds = max(self.max_render_seconds, elapsed)
+        return body
+
+
 def extract_text_content(message_content: Any) -> str:
     if message_content is None:
         return ""
@@ -349,28 +777,128 @@ def render_bounding_boxes(
     return output
 
 
-def request_completion(api_base: str, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+def _new_http_session(pool_size: int, host_count: int = 1) -> requests.Session:
+    pool_size = max(1, pool_size)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max(pool_size, host_count), pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def configure_http_session(
+    pool_size: int = HTTP_POOL_SIZE_DEFAULT, host_count: int = 1
+) -> requests.Session:
+    """Replace the shared keep-alive session with one sized for ``pool_size`` concurrent requests.
+
+    ``host_count`` is the number of distinct endpoints, so each keeps its own connection pool.
+    """
+    global _http_session
+    session = _new_http_session(pool_size, host_count)
+    with _http_session_lock:
+        previous, _http_session = _http_session, session
+    if previous is not None:
+        previous.close()
+    return session
+
+
+def get_http_session() -> requests.Session:
+    """Return the shared session, creating it with the default pool size on first use."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            _http_session = _new_http_session(HTTP_POOL_SIZE_DEFAULT)
+        return _http_session
+
+
+def http_session_stats() -> Dict[str, int]:
+    """Summarize how many requests were served over reused keep-alive connections."""
+    stats = {"requests": 0, "connections_opened": 0, "connections_reused": 0}
+    with _http_session_lock:
+        session = _http_session
+    if session is None:
+        return stats
+
+    seen_adapters = set()
+    for adapter in session.adapters.values():
+        if id(adapter) in seen_adapters:
+            continue
+        seen_adapters.add(id(adapter))
+        pools = getattr(getattr(adapter, "poolmanager", None), "pools", None)
+        if pools is None:
+            continue
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats["requests"] += getattr(pool, "num_requests", 0)
+            stats["connections_opened"] += getattr(pool, "num_connections", 0)
+    stats["connections_reused"] = max(0, stats["requests"] - stats["connections_opened"])
+    return stats
+
+
+def print_http_session_stats() -> None:
+    stats = http_session_stats()
+    if not stats["requests"]:
+        return
+    reuse_ratio = stats["connections_reused"] / stats["requests"]
+    print(
+        f"HTTP connections: {stats['requests']} requests over {stats['connections_opened']} "
+        f"connections ({stats['connections_reused']} reused, {reuse_ratio:.0%} reuse)"
+    )
+
+
+def _post_body(payload: Union[Dict[str, Any], bytes, bytearray]) -> Dict[str, Any]:
+    """``requests`` keyword arguments for a payload dict or an already serialized JSON body."""
+    if isinstance(payload, (bytes, bytearray)):
+        return {"data": payload, "headers": {"Content-Type": "application/json"}}
+    return {"json": payload}
+
+
+def request_completion(
+    api_base: str, payload: Union[Dict[str, Any], bytes, bytearray], timeout: float
+) -> Dict[str, Any]:
     url = f"{api_base.rstrip('/')}/chat/completions"
     try:
-        response = requests.post(url, json=payload, timeout=timeout)
+        response = get_http_session().post(url, timeout=timeout, **_post_body(payload))
     except requests.Timeout as exc:
         raise DetectionError(
             f"Request to {url} timed out after {timeout:.0f} seconds. "
-            "Increase --timeout or check server load."
+            "Increase --timeout or check server load.",
+            kind="timeout",
         ) from exc
     except requests.RequestException as exc:
-        raise DetectionError(f"Failed to reach the model endpoint: {exc}") from exc
+        raise DetectionError(
+            f"Failed to reach the model endpoint: {exc}", kind="transport"
+        ) from exc
+
+    return parse_completion_response(response.status_code, response.text)
+
+
+def probe_endpoint(api_base: str, timeout: float = HEALTH_PROBE_TIMEOUT) -> bool:
+    """Return True when ``GET {api_base}/models`` answers successfully."""
+    url = f"{api_base.rstrip('/')}/models"
+    try:
+        response = get_http_session().get(url, timeout=timeout)
+    except requests.RequestException:
+        return False
+    return response.ok
+
 
-    if not response.ok:
-        snippet = response.text[:500]
+def parse_completion_response(status_code: int, text: str) -> Dict[str, Any]:
+    """Validate a raw chat-completions HTTP response and return the decoded body."""
+    if status_code >= 400:
+        snippet = text[:500]
         raise DetectionError(
-            f"Model endpoint returned HTTP {response.status_code}. Response snippet: {snippet}"
+            f"Model endpoint returned HTTP {status_code}. Response snippet: {snippet}",
+            kind="http",
+            status_code=status_code,
         )
 
     try:
-        body = response.json()
+        body = json.loads(text)
     except JSONDecodeError as exc:
-        snippet = response.text[:500]
+        snippet = text[:500]
         raise DetectionError(f"Could not decode JSON response: {exc}. Snippet: {snippet}") from exc
 
     if isinstance(body, dict) and "error" in body:
@@ -384,6 +912,278 @@ def request_completion(api_base: str, payload: Dict[str, Any], timeout: float) -
     return body
 
 
+class DetectionStreamParser:
+    """Incrementally pull complete detection objects out of a streamed JSON array.
+
+    Text before the first top-level ``[`` (code fences, stray prose) is skipped. Each call to
+    ``feed`` returns the objects completed by that chunk; ``closed`` becomes True once the
+    top-level array has been closed.
+    """
+
+    def __init__(self) -> None:
+        self.closed = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._object_chars: List[str] = []
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        completed: List[Dict[str, Any]] = []
+        for char in text:
+            if self.closed:
+                break
+            if self._depth >= 2:
+                self._object_chars.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if char == '"':
+                self._in_string = self._depth > 0
+            elif char in "[{":
+                if self._depth == 0 and char == "{":
+                    continue
+                self._depth += 1
+                if self._depth == 2:
+                    self._object_chars = [char]
+            elif char in "]}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 1:
+                    try:
+                        parsed = json.loads("".join(self._object_chars))
+                    except ValueError:
+                        parsed = None
+                    if isinstance(parsed, dict):
+                        completed.append(parsed)
+                    self._object_chars = []
+                elif self._depth == 0:
+                    self.closed = True
+        return completed
+
+
+class CompletionStreamAccumulator:
+    """Rebuild a chat-completions body from server-sent event lines.
+
+    Content and reasoning deltas are concatenated as they arrive, detections are parsed
+    incrementally from the content, and timing is tracked: time to first token and the
+    gaps between token-bearing chunks. ``result`` returns a body shaped like a
+    non-streaming response with the timings under ``stream_metrics``.
+    """
+
+    def __init__(
+        self,
+        started_at: float,
+        stop_at_array_end: bool = False,
+        on_detection: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ) -> None:
+        self.started_at = started_at
+        self.stop_at_array_end = stop_at_array_end
+        self.on_detection = on_detection
+        self.parser = DetectionStreamParser()
+        self.content: List[str] = []
+        self.reasoning: List[str] = []
+        self.finish_reason: Optional[str] = None
+        self.usage: Optional[Dict[str, Any]] = None
+        self.model: Optional[str] = None
+        self.created: Optional[int] = None
+        self.first_token_at: Optional[float] = None
+        self.last_token_at: Optional[float] = None
+        self.token_gaps: List[float] = []
+        self.chunks = 0
+        self.detections_streamed = 0
+        self.closed_early = False
+
+    def feed_line(self, line: str) -> bool:
+        """Consume one SSE line; return True once the stream can be closed."""
+        if not line.startswith("data:"):
+            return False
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return True
+        try:
+            chunk = json.loads(data)
+        except JSONDecodeError as exc:
+            raise DetectionError(
+                f"Could not decode stream chunk: {exc}. Chunk: {data[:500]}"
+            ) from exc
+        if isinstance(chunk, dict) and "error" in chunk:
+            # Reuse the error-payload handling of non-streaming responses.
+            parse_completion_response(200, data)
+
+        self.chunks += 1
+        self.model = chunk.get("model") or self.model
+        self.created = chunk.get("created") or self.created
+        if chunk.get("usage"):
+            self.usage = chunk["usage"]
+        for choice in chunk.get("choices") or []:
+            if not isinstance(choice, dict) or choice.get("index", 0) != 0:
+                continue
+            delta = choice.get("delta") or {}
+            reasoning_piece = delta.get("reasoning_content") or delta.get("reasoning")
+            content_piece = delta.get("content")
+            if reasoning_piece or content_piece:
+                self._mark_token()
+            if reasoning_piece:
+                self.reasoning.append(reasoning_piece)
+            if content_piece:
+                self.content.append(content_piece)
+                for detection in self.parser.feed(content_piece):
+                    self.detections_streamed += 1
+                    if self.on_detection is not None:
+                        self.on_detection(detection)
+            if choice.get("finish_reason"):
+                self.finish_reason = choice["finish_reason"]
+
+        if self.stop_at_array_end and self.parser.closed and self.finish_reason is None:
+            # Not "stop": the server never finished, and usage is missing.
+            self.closed_early = True
+            self.finish_reason = "early_stop"
+            return True
+        return False
+
+    def result(self) -> Dict[str, Any]:
+        message: Dict[str, Any] = {"role": "assistant", "content": "".join(self.content)}
+        if self.reasoning:
+            message["reasoning_content"] = "".join(self.reasoning)
+        ttft = self.first_token_at - self.started_at if self.first_token_at is not None else None
+        mean_gap = sum(self.token_gaps) / len(self.token_gaps) if self.token_gaps else None
+        return {
+            "model": self.model,
+            "created": self.created,
+            "choices": [{"index": 0, "message": message, "finish_reason": self.finish_reason}],
+            "usage": self.usage,
+            "stream_metrics": {
+                "ttft_seconds": ttft,
+                "mean_inter_token_seconds": mean_gap,
+                "max_inter_token_seconds": max(self.token_gaps) if self.token_gaps else None,
+                "chunks": self.chunks,
+                "detections_streamed": self.detections_streamed,
+                "closed_early": self.closed_early,
+            },
+        }
+
+    def _mark_token(self) -> None:
+        now = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        elif self.last_token_at is not None:
+            self.token_gaps.append(now - self.last_token_at)
+        self.last_token_at = now
+
+
+class CancelToken:
+    """Cancels a streaming request from another thread.
+
+    Behaves like a ``threading.Event``, but ``set`` also shuts down the socket of the
+    response currently attached, so a read blocked waiting for the next chunk fails at
+    once instead of after ``timeout``.
+    """
+
+    def __init__(self) -> None:
+        self._event = Event()
+        self._lock = Lock()
+        self._socket: Optional[socket.socket] = None
+
+    def is_set(self) -> bool:
+        return self._event.is_set()
+
+    def set(self) -> None:
+        with self._lock:
+            self._event.set()
+            sock, self._socket = self._socket, None
+        _shutdown_socket(sock)
+
+    def attach(self, response: requests.Response) -> None:
+        # urllib3 keeps the connection on the raw response while the body is streamed.
+        sock = getattr(getattr(response.raw, "_connection", None), "sock", None)
+        with self._lock:
+            if not self._event.is_set():
+                self._socket = sock
+                return
+        _shutdown_socket(sock)
+
+    def detach(self) -> None:
+        """Forget the socket before its connection goes back to the pool."""
+        with self._lock:
+            self._socket = None
+
+
+def _cancelled_error(url: str) -> DetectionError:
+    return DetectionError(f"Streaming request to {url} was cancelled.", kind="cancelled")
+
+
+def _shutdown_socket(sock: Optional[socket.socket]) -> None:
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def streaming_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
+    return {**payload, "stream": True, "stream_options": {"include_usage": True}}
+
+
+def request_completion_stream(
+    api_base: str,
+    payload: Union[Dict[str, Any], bytes, bytearray],
+    timeout: float,
+    stop_at_array_end: bool = False,
+    on_detection: Optional[Callable[[Dict[str, Any]], None]] = None,
+    cancel: Optional[CancelToken] = None,
+) -> Dict[str, Any]:
+    """Streaming counterpart of ``request_completion``.
+
+    ``timeout`` bounds each read rather than the whole generation. With
+    ``stop_at_array_end`` the connection is closed as soon as the detection array is
+    complete, which skips any trailing tokens (and the final usage chunk); the result's
+    ``finish_reason`` is then ``"early_stop"``. Setting ``cancel`` from another thread
+    closes the connection at once, which makes vLLM abort the generation. A
+    pre-serialized ``payload`` must already request streaming (see ``streaming_payload``).
+    """
+    url = f"{api_base.rstrip('/')}/chat/completions"
+    if isinstance(payload, dict):
+        payload = streaming_payload(payload)
+    started_at = time.perf_counter()
+    accumulator = CompletionStreamAccumulator(started_at, stop_at_array_end, on_detection)
+    try:
+        with get_http_session().post(
+            url, timeout=timeout, stream=True, **_post_body(payload)
+        ) as response:
+            if response.status_code >= 400:
+                parse_completion_response(response.status_code, response.text)
+            if cancel is not None:
+                cancel.attach(response)
+            try:
+                for line in response.iter_lines(decode_unicode=True):
+                    if line and accumulator.feed_line(line):
+                        break
+            finally:
+                if cancel is not None:
+                    cancel.detach()
+    except requests.RequestException as exc:
+        if cancel is not None and cancel.is_set():
+            raise _cancelled_error(url) from exc
+        if isinstance(exc, requests.Timeout):
+            raise DetectionError(
+                f"Streaming request to {url} stalled for more than {timeout:.0f} seconds. "
+                "Increase --timeout or check server load.",
+                kind="timeout",
+            ) from exc
+        raise DetectionError(
+            f"Failed to reach the model endpoint: {exc}", kind="transport"
+        ) from exc
+    if cancel is not None and cancel.is_set():
+        # The shutdown can also look like a clean end of the stream.
+        raise _cancelled_error(url)
+    return accumulator.result()
+
+
 def extract_detections(body: Dict[str, Any]) -> Tuple[Sequence[Dict[str, Any]], str, Dict[str, Any], Dict[str, Any]]:
     try:
         choices = body["choices"]
@@ -455,8 +1255,9 @@ def extract_detections(body: Dict[str, Any]) -> Tuple[Sequence[Dict[str, Any]],
         raise DetectionError(
             "\n".join(details),
             generation_details=generation_details,
+            kind="length",
         )
-    if finish_reason and finish_reason not in ("stop", None):
+    if finish_reason and finish_reason not in ("stop", "early_stop", None):
         warn(f"Model finish_reason: {finish_reason}")
 
     try:
@@ -570,7 +1371,11 @@ def sanitize_detections(detections: Sequence[Dict[str, Any]]) -> List[Dict[str,
     return cleaned
 
 
-def load_example_pairs(pairs: Sequence[Tuple[Path, Path]]) -> List[Tuple[str, str]]:
+def load_example_pairs(
+    pairs: Sequence[Tuple[Path, Path]],
+    transport: str = "base64",
+    encoding: Optional[ImageEncoding] = None,
+) -> List[Tuple[str, str]]:
     examples: List[Tuple[str, str]] = []
     for image_path, json_path in pairs:
         if not image_path.is_file():
@@ -578,7 +1383,7 @@ def load_example_pairs(pairs: Sequence[Tuple[Path, Path]]) -> List[Tuple[str, st
         if not json_path.is_file():
             raise FileNotFoundError(f"Example annotation not found: {json_path}")
 
-        image_data = encode_image(image_path)
+        image_data = image_reference(image_path, transport, encoding)
         with json_path.open("r", encoding="utf-8") as handle:
             try:
                 parsed = json.load(handle)
@@ -594,12 +1399,14 @@ def load_example_pairs(pairs: Sequence[Tuple[Path, Path]]) -> List[Tuple[str, st
     return examples
 
 
-def load_context_images(paths: Sequence[Path]) -> List[str]:
+def load_context_images(
+    paths: Sequence[Path], transport: str = "base64", encoding: Optional[ImageEncoding] = None
+) -> List[str]:
     encoded_images: List[str] = []
     for image_path in paths:
         if not image_path.is_file():
             raise FileNotFoundError(f"Context image not found: {image_path}")
-        encoded_images.append(encode_image(image_path))
+        encoded_images.append(image_reference(image_path, transport, encoding))
     return encoded_images
 
 
@@ -625,6 +1432,15 @@ def print_generation_info(raw_body: Dict[str, Any], elapsed_seconds: float) -> N
         print(usage_str)
     else:
         print("Usage: not provided by server.")
+    stream_metrics = raw_body.get("stream_metrics")
+    if isinstance(stream_metrics, dict):
+        ttft = stream_metrics.get("ttft_seconds")
+        mean_gap = stream_metrics.get("mean_inter_token_seconds")
+        print(f"Time to first token: {ttft:.2f}s" if ttft is not None else "Time to first token: n/a")
+        if mean_gap is not None:
+            print(f"Mean inter-token latency: {mean_gap * 1000:.1f}ms")
+        if stream_metrics.get("closed_early"):
+            print("Stream closed early once the detection array was complete.")
 
 
 def save_generation_details(
@@ -678,12 +1494,19 @@ def main() -> None:
     example_specs = [
         (Path(image_path), Path(annotation_path)) for image_path, annotation_path in (args.example or [])
     ]
-    examples = load_example_pairs(example_specs) if example_specs else []
+    encoding = image_encoding_from_args(args)
+    examples = (
+        load_example_pairs(example_specs, args.image_transport, encoding) if example_specs else []
+    )
 
     context_specs = [Path(path) for path in (args.context_image or [])]
-    context_images = load_context_images(context_specs) if context_specs else None
+    context_images = (
+        load_context_images(context_specs, args.image_transport, encoding)
+        if context_specs
+        else None
+    )
 
-    image_data = encode_image(args.image_path)
+    image_data = image_reference(args.image_path, args.image_transport, encoding)
     payload = build_payload(
         args.prompt,
         image_data,
@@ -700,7 +1523,18 @@ def main() -> None:
     )
 
     start_time = time.perf_counter()
-    body = request_completion(args.api_base, payload, args.timeout)
+    if args.stream or args.stream_early_stop:
+        body = request_completion_stream(
+            args.api_base,
+            payload,
+            args.timeout,
+            stop_at_array_end=args.stream_early_stop,
+            on_detection=lambda detection: print(
+                f"Streamed detection: {json.dumps(detection, ensure_ascii=False)}"
+            ),
+        )
+    else:
+        body = request_completion(args.api_base, payload, args.timeout)
     elapsed = time.perf_counter() - start_time
 
     try:
@@ -750,6 +1584,7 @@ def main() -> None:
         )
 
     print_generation_info(raw_body, elapsed)
+    print_image_transport_stats()
     show_image(annotated_image, title=f"{args.image_path.name} detections")
 
 @lru_cache(maxsize=None)
@@ -14,12 +14,17 @@ from PIL import Image, ImageDraw
 
 from query_bbox import (
     DetectionError,
+    IMAGE_TRANSPORTS,
     SYSTEM_PROMPT,
+    add_image_encoding_arguments,
     build_payload,
-    encode_image,
     extract_detections,
     get_label_font,
+    image_encoding_from_args,
+    image_reference,
     normalize_bbox,
+    print_http_session_stats,
+    print_image_transport_stats,
     request_completion,
     sanitize_detections,
 )
@@ -67,6 +72,17 @@ def parse_args() -> argparse.Namespace:
         default=120.0,
         help="Request timeout in seconds (default: %(default)s).",
     )
+    parser.add_argument(
+        "--image-transport",
+        choices=IMAGE_TRANSPORTS,
+        default="base64",
+        help=(
+            "How the original image reaches the server: base64 data URL or file:// path "
+            "(needs vLLM --allowed-local-media-path). Overlays are always sent inline "
+            "(default: %(default)s)."
+        ),
+    )
+    add_image_encoding_arguments(parser)
     parser.add_argument(
         "--output-dir",
         type=Path,
@@ -262,7 +278,9 @@ def iterative_refinement(args: argparse.Namespace) -> None:
         raise FileNotFoundError(f"Image not found: {args.image_path}")
 
     original_image = Image.open(args.image_path).convert("RGB")
-    original_image_data = encode_image(args.image_path)
+    original_image_data = image_reference(
+        args.image_path, args.image_transport, image_encoding_from_args(args)
+    )
     output_dir = args.output_dir
     image_stem = args.image_path.stem
 
@@ -302,6 +320,8 @@ def iterative_refinement(args: argparse.Namespace) -> None:
 
     print("Final detections:")
     print(json.dumps(detections, ensure_ascii=False, indent=2))
+    print_http_session_stats()
+    print_image_transport_stats()
     print("Displaying iteration overlays...")
     display_iterations(iteration_images)
 
@@ -11,6 +11,8 @@ from typing import Any, Dict, Iterable, List, Sequence
 import requests
 from PIL import Image, ImageDraw, ImageFont
 
+from query_bbox import get_http_session
+
 
 POSE_LABELS: List[str] = [
     "nose",
@@ -178,7 +180,7 @@ def parse_keypoint_json(raw_text: str) -> List[Dict[str, Any]]:
 def request_completion(api_base: str, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
     url = f"{api_base.rstrip('/')}/chat/completions"
     try:
-        response = requests.post(url, json=payload, timeout=timeout)
+        response = get_http_session().post(url, json=payload, timeout=timeout)
     except requests.Timeout as exc:
         raise PoseEstimationError(
             f"Request to {url} timed out after {timeout:.0f} seconds. "
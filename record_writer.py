@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""Single background writer for batch_detect's results and generation-details JSONL files."""
+
+import gzip
+import json
+import os
+import queue
+import time
+from pathlib import Path
+from threading import Lock, Thread
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from query_bbox import warn
+
+FSYNC_POLICIES = ("never", "flush", "record")
+DETAILS_LEVELS = ("none", "usage", "full")
+# Fields kept by --details-level usage; everything else is dropped.
+USAGE_FIELDS = (
+    "image",
+    "elapsed_seconds",
+    "finish_reason",
+    "cache",
+    "error",
+    "error_kind",
+    "attempts",
+    "token_budget",
+    "usage",
+)
+# Response message fields that usually repeat assistant_text or cot_text verbatim.
+_MESSAGE_TEXT_FIELDS = ("content", "reasoning_content", "reasoning")
+_RESULTS = 0
+_DETAILS = 1
+_COT = 2
+_FAILURES = 3
+
+
+def derive_cot_path(details_path: Path) -> Path:
+    return details_path.with_suffix(".cot.gz")
+
+
+def _dedupe_response(response: Any, texts: Dict[str, str]) -> Any:
+    """Replace message fields equal to one of ``texts`` by ``{"$ref": name}``."""
+    if not isinstance(response, dict) or not isinstance(response.get("choices"), list):
+        return response
+    choices = []
+    for choice in response["choices"]:
+        message = choice.get("message") if isinstance(choice, dict) else None
+        if isinstance(message, dict):
+            message = dict(message)
+            for field in _MESSAGE_TEXT_FIELDS:
+                value = message.get(field)
+                for name, text in texts.items():
+                    if isinstance(value, str) and value and value == text:
+                        message[field] = {"$ref": name}
+                        break
+            choice = dict(choice, message=message)
+        choices.append(choice)
+    return dict(response, choices=choices)
+
+
+def _resolve_refs(value: Any, texts: Dict[str, Optional[str]]) -> Any:
+    if isinstance(value, dict):
+        if set(value) == {"$ref"} and value["$ref"] in texts:
+            return texts[value["$ref"]]
+        return {key: _resolve_refs(item, texts) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_resolve_refs(item, texts) for item in value]
+    return value
+
+
+class RecordWriter:
+    """Append JSONL records from any thread without blocking on file I/O.
+
+    Callers serialize their record and hand the line to a queue; one thread owns the files,
+    keeps them open, and writes buffered lines once ``flush_bytes`` are pending or
+    ``flush_seconds`` have passed. ``fsync`` controls durability: ``never`` leaves the data to
+    the OS, ``flush`` syncs after every batch and ``record`` flushes and syncs each record.
+    Details are always written before results, so a result line implies its details exist.
+    A write error stops the thread and is re-raised to the next caller.
+
+    ``details_level`` shapes generation details: ``none`` writes no details file, ``usage``
+    keeps timing, finish reason, token usage and attempts, and ``full`` keeps everything but
+    stores each chain-of-thought once, as its own gzip member in ``cot_path``, referenced by
+    byte offset and length. Response fields that repeat ``assistant_text`` or the CoT become
+    ``{"$ref": ...}`` markers; ``DetailsReader`` restores the original record.
+
+    With a ``failures_path``, ``write_failure`` appends to a failure ledger, and a result for
+    an image in ``open_failures`` (failed earlier, e.g. in a previous pass) appends a
+    ``{"resolved": true}`` entry for it, so the ledger alone tells what still needs a retry.
+    """
+
+    def __init__(
+        self,
+        results_path: Path,
+        details_path: Path,
+        fsync: str = "never",
+        flush_bytes: int = 1 << 20,
+        flush_seconds: float = 1.0,
+        details_level: str = "full",
+        cot_path: Optional[Path] = None,
+        failures_path: Optional[Path] = None,
+        open_failures: Optional[Set[str]] = None,
+    ) -> None:
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        if details_level not in DETAILS_LEVELS:
+            raise ValueError(f"Unknown details level: {details_level}")
+        self.details_level = details_level
+        self.paths: Tuple[Optional[Path], ...] = (
+            results_path,
+            details_path if details_level != "none" else None,
+            (cot_path or derive_cot_path(details_path)) if details_level == "full" else None,
+            failures_path,
+        )
+        self.open_failures: Set[str] = set(open_failures or ())
+        self.fsync = fsync
+        self.flush_bytes = 0 if fsync == "record" else flush_bytes
+        self.flush_seconds = flush_seconds
+        self.records = 0
+        self.bytes_written = 0
+        self.cot_bytes = 0
+        self.flushes = 0
+        self.fsyncs = 0
+        self.io_seconds = 0.0
+        self.error: Optional[BaseException] = None
+        self._started_at = time.monotonic()
+        self._stats_lock = Lock()
+        self._queue: "queue.Queue[Optional[Tuple[Any, ...]]]" = queue.Queue()
+        self._thread = Thread(target=self._run, name="record-writer", daemon=True)
+        self._thread.start()
+
+    def write_result(
+        self, record: Dict[str, Any], on_written: Optional[Callable[[], Any]] = None
+    ) -> None:
+        """Queue a result line; ``on_written`` runs on the writer thread once it is on disk."""
+        if record["image"] in self.open_failures:
+            self.open_failures.discard(record["image"])
+            self._put(_FAILURES, json.dumps({"image": record["image"], "resolved": True}, separators=(",", ":")))
+        self._put(_RESULTS, json.dumps(record, separators=(",", ":")), on_written=on_written)
+
+    def write_failure(self, entry: Dict[str, Any]) -> None:
+        if self.paths[_FAILURES] is None:
+            return
+        self.open_failures.add(entry["image"])
+        self._put(_FAILURES, json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+
+    def write_details(self, record: Dict[str, Any]) -> None:
+        if self.details_level == "none":
+            return
+        if self.details_level == "usage":
+            slim = {key: record[key] for key in USAGE_FIELDS if key in record}
+            response = record.get("response")
+            if isinstance(response, dict) and response.get("usage") is not None:
+                slim.setdefault("usage", response["usage"])
+            self._put(_DETAILS, _dumps_details(slim))
+            return
+
+        compact = dict(record)
+        cot_text = compact.get("cot_text")
+        texts = {"assistant_text": compact.get("assistant_text"), "cot_text": cot_text}
+        if "response" in compact:
+            compact["response"] = _dedupe_response(
+                compact["response"], {name: text for name, text in texts.items() if text}
+            )
+        if not cot_text:
+            self._put(_DETAILS, _dumps_details(compact))
+            return
+        del compact["cot_text"]
+        # The CoT offset is only known on the writer thread, which serializes this record.
+        self._put(_DETAILS, compact, gzip.compress(cot_text.encode("utf-8"), compresslevel=6))
+
+    def close(self) -> None:
+        """Write everything still queued, close the files and re-raise any write error."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def summary(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            elapsed = max(time.monotonic() - self._started_at, 1e-9)
+            return {
+                "records": self.records,
+                "bytes": self.bytes_written,
+                "cot_bytes": self.cot_bytes,
+                "flushes": self.flushes,
+                "fsyncs": self.fsyncs,
+                "io_seconds": self.io_seconds,
+                "bytes_per_second": self.bytes_written / elapsed,
+            }
+
+    def _put(
+        self,
+        stream: int,
+        line: Any,
+        blob: Optional[bytes] = None,
+        on_written: Optional[Callable[[], Any]] = None,
+    ) -> None:
+        if self.error is not None:
+            raise self.error
+        if isinstance(line, str):
+            line = (line + "\n").encode("utf-8")
+        self._queue.put((stream, line, blob, on_written))
+
+    def _run(self) -> None:
+        pending: Tuple[List[bytes], ...] = ([], [], [], [])
+        callbacks: List[Callable[[], Any]] = []
+        pending_bytes = 0
+        last_flush = time.monotonic()
+        handles: List[Optional[BinaryIO]] = []
+        try:
+            for path in self.paths:
+                if path is not None:
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                handles.append(path.open("ab") if path is not None else None)
+            cot_offset = handles[_COT].tell() if handles[_COT] is not None else 0
+            closing = False
+            while not closing:
+                timeout = max(last_flush + self.flush_seconds - time.monotonic(), 0.0)
+                try:
+                    item = self._queue.get(timeout=timeout if pending_bytes else None)
+                except queue.Empty:
+                    item = ()
+                if item is None:
+                    closing = True
+                elif item:
+                    stream, line, blob, on_written = item
+                    if on_written is not None:
+                        callbacks.append(on_written)
+                    if blob is not None:
+                        line["cot"] = {"offset": cot_offset, "length": len(blob)}
+                        line = (_dumps_details(line) + "\n").encode("utf-8")
+                        pending[_COT].append(blob)
+                        cot_offset += len(blob)
+                        pending_bytes += len(blob)
+                    pending[stream].append(line)
+                    pending_bytes += len(line)
+                if pending_bytes and (
+                    closing
+                    or pending_bytes >= self.flush_bytes
+                    or time.monotonic() - last_flush >= self.flush_seconds
+                ):
+                    self._flush(handles, pending)
+                    pending_bytes = 0
+                    for callback in callbacks:
+                        try:
+                            callback()
+                        except Exception as exc:
+                            warn(f"Record writer callback failed: {exc}")
+                    callbacks.clear()
+                    last_flush = time.monotonic()
+        except BaseException as exc:  # pragma: no cover - disk full, permissions, ...
+            warn(f"Record writer stopped: {exc}")
+            self.error = exc
+        finally:
+            for handle in handles:
+                if handle is not None:
+                    handle.close()
+
+    def _flush(self, handles: List[Optional[BinaryIO]], pending: Tuple[List[bytes], ...]) -> None:
+        started = time.monotonic()
+        written = 0
+        records = len(pending[_RESULTS]) + len(pending[_DETAILS]) + len(pending[_FAILURES])
+        cot_written = sum(len(blob) for blob in pending[_COT])
+        for stream in (_COT, _DETAILS, _FAILURES, _RESULTS):
+            handle = handles[stream]
+            if not pending[stream] or handle is None:
+                continue
+            data = b"".join(pending[stream])
+            handle.write(data)
+            handle.flush()
+            if self.fsync != "never":
+                os.fsync(handle.fileno())
+                with self._stats_lock:
+                    self.fsyncs += 1
+            written += len(data)
+            pending[stream].clear()
+        with self._stats_lock:
+            self.records += records
+            self.bytes_written += written
+            self.cot_bytes += cot_written
+            self.flushes += 1
+            self.io_seconds += time.monotonic() - started
+
+
+def _dumps_details(record: Dict[str, Any]) -> str:
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+
+
+class DetailsReader:
+    """Read generation details written by ``RecordWriter`` back into full records.
+
+    Iterating yields every record with its chain-of-thought and response text restored;
+    ``expand`` does the same for a single parsed line and ``cot`` fetches one CoT by its
+    reference, seeking straight to its gzip member.
+    """
+
+    def __init__(self, details_path: Path, cot_path: Optional[Path] = None) -> None:
+        self.details_path = details_path
+        self.cot_path = cot_path or derive_cot_path(details_path)
+        self._cot_handle: Optional[BinaryIO] = None
+
+    def __enter__(self) -> "DetailsReader":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        with self.details_path.open("r", encoding="utf-8") as handle:
+            for line in handle:
+                if line.strip():
+                    yield self.expand(json.loads(line))
+
+    def cot(self, reference: Dict[str, int]) -> str:
+        if self._cot_handle is None:
+            self._cot_handle = self.cot_path.open("rb")
+        self._cot_handle.seek(reference["offset"])
+        return gzip.decompress(self._cot_handle.read(reference["length"])).decode("utf-8")
+
+    def expand(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        expanded = dict(record)
+        reference = expanded.pop("cot", None)
+        if reference is not None:
+            expanded["cot_text"] = self.cot(reference)
+        if "response" in expanded:
+            texts = {
+                "assistant_text": expanded.get("assistant_text"),
+                "cot_text": expanded.get("cot_text"),
+            }
+            expanded["response"] = _resolve_refs(expanded["response"], texts)
+        return expanded
+
+    def close(self) -> None:
+        if self._cot_handle is not None:
+            self._cot_handle.close()
+            self._cot_handle = None
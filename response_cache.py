@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""Persistent, content-addressed cache of chat-completion responses for batch_detect."""
+
+import base64
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Any, Dict, Optional, Sequence
+from urllib.parse import unquote, urlparse
+
+from query_bbox import IMAGE_PLACEHOLDER, PayloadTemplate, warn
+
+CACHE_MODES = ("read-write", "read-only", "refresh", "off")
+# Request fields that change how the response is delivered, not what the model generates.
+_DELIVERY_FIELDS = {"stream", "stream_options"}
+
+
+def _hash_image_url(image_url: str) -> str:
+    """Hash the image bytes behind a data URL or ``file://`` URL (other URLs hash as text)."""
+    digest = hashlib.sha256()
+    if image_url.startswith("file://"):
+        path = Path(unquote(urlparse(image_url).path))
+        with path.open("rb") as handle:
+            for chunk in iter(lambda: handle.read(1 << 20), b""):
+                digest.update(chunk)
+    elif image_url.startswith("data:") and ";base64," in image_url:
+        digest.update(base64.b64decode(image_url.split(";base64,", 1)[1]))
+    else:
+        digest.update(image_url.encode("utf-8"))
+    return f"sha256:{digest.hexdigest()}"
+
+
+def _canonicalize(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {
+            key: _hash_image_url(item)
+            if key == "image_url" and isinstance(item, str) and item != IMAGE_PLACEHOLDER
+            else _canonicalize(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [_canonicalize(item) for item in value]
+    return value
+
+
+def _canonical_request(payload: Dict[str, Any]) -> bytes:
+    relevant = {key: value for key, value in payload.items() if key not in _DELIVERY_FIELDS}
+    canonical = json.dumps(
+        _canonicalize(relevant), sort_keys=True, ensure_ascii=False, separators=(",", ":")
+    )
+    return canonical.encode("utf-8")
+
+
+def request_cache_key(payload: Dict[str, Any]) -> str:
+    """Hash everything in ``payload`` that influences the generation.
+
+    Images are replaced by the hash of their bytes, so the same file sent as base64 or as a
+    ``file://`` path shares an entry, and an edited file misses. The system prompt, few-shot
+    and context turns, model and every decoding parameter (including the seed) are part of
+    the messages and options already.
+    """
+    return hashlib.sha256(_canonical_request(payload)).hexdigest()
+
+
+class CacheKeyTemplate:
+    """``request_cache_key`` for a ``PayloadTemplate``, given only the target image's digest.
+
+    The canonical form of the template is computed once; ``key`` splices in the image hash
+    and yields the same key ``request_cache_key`` gives for the rendered payload.
+    """
+
+    def __init__(self, template: PayloadTemplate) -> None:
+        marker = json.dumps(IMAGE_PLACEHOLDER).encode("utf-8")
+        self.head, self.tail = _canonical_request(template.payload).split(marker)
+
+    def key(self, image_sha256: str) -> str:
+        digest = hashlib.sha256(self.head)
+        digest.update(f'"sha256:{image_sha256}"'.encode("ascii"))
+        digest.update(self.tail)
+        return digest.hexdigest()
+
+
+class ResponseCache:
+    """SQLite-backed response store with size-bounded LRU eviction.
+
+    ``read-write`` serves hits and stores misses, ``read-only`` never writes, ``refresh``
+    ignores existing entries but stores new responses over them, and ``off`` disables the
+    cache. Only responses that produced a usable detection record should be stored.
+    """
+
+    def __init__(self, path: Path, mode: str = "read-write", max_bytes: int = 1 << 30) -> None:
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._total_bytes = 0
+        if mode == "off":
+            return
+        if mode == "read-only":
+            if not path.exists():
+                warn(f"Response cache {path} does not exist; every request will miss.")
+                return
+            self._connection = sqlite3.connect(
+                f"{path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False
+            )
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(str(path), check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, body TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)"
+            )
+            self._connection.commit()
+        row = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+        self._total_bytes = row[0]
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self.get_first([key])
+
+    def get_first(self, keys: Sequence[str]) -> Optional[Dict[str, Any]]:
+        """Body stored under the first of ``keys`` that has one; one hit or miss either way."""
+        if self.mode == "off":
+            return None
+        if self.mode == "refresh" or self._connection is None or not keys:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            for key in keys:
+                row = self._connection.execute(
+                    "SELECT body FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    break
+            else:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self.mode == "read-write":
+                self._connection.execute(
+                    "UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key)
+                )
+                self._connection.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, body: Dict[str, Any]) -> None:
+        if self.mode not in ("read-write", "refresh") or self._connection is None:
+            return
+        encoded = json.dumps(body, ensure_ascii=False, separators=(",", ":"))
+        size = len(encoded.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            previous = self._connection.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, body, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, encoded, size, now, now),
+            )
+            self._total_bytes += size - (previous[0] if previous else 0)
+            self.stores += 1
+            self._evict()
+            self._connection.commit()
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "size_bytes": self._total_bytes,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _evict(self) -> None:
+        """Drop least recently used entries until the cache fits in ``max_bytes``."""
+        assert self._connection is not None
+        while self._total_bytes > self.max_bytes:
+            rows = self._connection.execute(
+                "SELECT key, size FROM responses ORDER BY accessed_at LIMIT 64"
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                return
+            for key, size in rows:
+                if self._total_bytes <= self.max_bytes:
+                    break
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._total_bytes -= size
+                self.evictions += 1
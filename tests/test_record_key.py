@@ -0,0 +1,34 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from batch_detect import load_processed_paths, record_key  # noqa: E402
+
+
+def test_complete_record():
+    assert record_key(b'{"image":"a.jpg","detections":[{"bbox_2d":[1,2,3,4]}]}\n') == "a.jpg"
+
+
+def test_record_cut_off_after_a_detection():
+    with pytest.raises(ValueError):
+        record_key(b'{"image":"a.jpg","detections":[{"bbox_2d":[1,2,3,4]}')
+
+
+def test_cut_off_record_with_a_resumed_record_appended():
+    with pytest.raises(ValueError):
+        record_key(
+            b'{"image":"a.jpg","detections":[{"bbox_2d":[1,2,3,4]}'
+            b'{"image":"b.jpg","detections":[]}\n'
+        )
+
+
+def test_resume_skips_cut_off_last_line(tmp_path):
+    results = tmp_path / "results.jsonl"
+    results.write_bytes(
+        b'{"image":"a.jpg","detections":[]}\n'
+        b'{"image":"b.jpg","detections":[{"bbox_2d":[1,2,3,4]}'
+    )
+    assert load_processed_paths(results) == {"a.jpg"}
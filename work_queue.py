@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""Durable SQLite work queue with leases, shared by cooperating batch_detect processes."""
+
+import os
+import socket
+import sqlite3
+import time
+from pathlib import Path
+from threading import Event, Lock, Thread
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set
+
+from query_bbox import warn
+
+_SEED_BATCH = 1000
+
+
+class WorkQueue:
+    """Lease-based queue of relative image paths in a SQLite file.
+
+    The first process to open an unseeded queue fills it from the dataset scan, in scan
+    order, while it and any other worker already claim items. ``claim`` hands out pending
+    items and items whose lease expired (their worker crashed) with a fresh lease;
+    a heartbeat thread keeps renewing the leases this worker holds until ``close``, which
+    returns anything unfinished to the queue. ``complete`` and ``fail`` only succeed while
+    the caller still owns the lease, so each item is finished by exactly one worker.
+
+    All processes must see the file through a filesystem with working POSIX locks.
+    """
+
+    def __init__(self, path: Path, lease_seconds: float = 600.0) -> None:
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.claimed = 0
+        self.recovered = 0
+        self.completed = 0
+        self.failed = 0
+        self.lost = 0
+        self._lock = Lock()
+        self._seeding = Event()
+        self._stop = Event()
+        self._final_summary: Optional[Dict[str, Any]] = None
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(
+            str(path), timeout=60.0, isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "path TEXT PRIMARY KEY, seq INTEGER NOT NULL, state TEXT NOT NULL, "
+            "owner TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, error TEXT)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS items_claim ON items (state, seq)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self._heartbeat = Thread(target=self._renew_leases, name="lease-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def seeded(self) -> bool:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM meta WHERE key = 'seeded'"
+            ).fetchone()
+        return row is not None
+
+    def start_seeding(self, rel_paths: Iterable[str], done: Optional[Set[str]] = None) -> None:
+        """Seed the queue on a background thread so claiming can start right away."""
+        self._seeding.set()
+        Thread(target=self.seed, args=(rel_paths, done), name="queue-seed", daemon=True).start()
+
+    def seed(self, rel_paths: Iterable[str], done: Optional[Set[str]] = None) -> None:
+        """Insert ``rel_paths`` in order; paths in ``done`` are recorded as already finished."""
+        self._seeding.set()
+        try:
+            batch: List[tuple] = []
+            for seq, rel_path in enumerate(rel_paths):
+                state = "done" if done and rel_path in done else "pending"
+                batch.append((rel_path, seq, state))
+                if len(batch) >= _SEED_BATCH:
+                    self._insert(batch)
+                    batch = []
+            self._insert(batch)
+            with self._lock:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('seeded', ?)",
+                    (str(time.time()),),
+                )
+        finally:
+            self._seeding.clear()
+
+    def claims(
+        self, dataset_root: Path, batch_size: int, done: Optional[Set[str]] = None
+    ) -> Iterator[Path]:
+        """Yield claimed images until nothing is left to claim and our seeding has finished.
+
+        Claimed paths already in ``done`` (e.g. found by ``--resume``) are completed on the
+        spot instead of being yielded.
+        """
+        while True:
+            claimed = self.claim(batch_size)
+            if not claimed:
+                if self._seeding.is_set():
+                    time.sleep(0.5)
+                    continue
+                return
+            for rel_path in claimed:
+                if done and rel_path in done:
+                    self.complete(rel_path)
+                else:
+                    yield dataset_root / rel_path
+
+    def claim(self, limit: int) -> List[str]:
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._connection.execute(
+                    "SELECT path, state FROM items WHERE state = 'pending' "
+                    "OR (state = 'leased' AND lease_until < ?) ORDER BY seq LIMIT ?",
+                    (now, limit),
+                ).fetchall()
+                self._connection.executemany(
+                    "UPDATE items SET state = 'leased', owner = ?, lease_until = ?, "
+                    "attempts = attempts + 1 WHERE path = ?",
+                    [(self.worker, now + self.lease_seconds, path) for path, _ in rows],
+                )
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self.claimed += len(rows)
+            self.recovered += sum(1 for _, state in rows if state == "leased")
+        return [path for path, _ in rows]
+
+    def complete(self, rel_path: str) -> bool:
+        return self._finish(rel_path, "done", None)
+
+    def fail(self, rel_path: str, error: str) -> bool:
+        return self._finish(rel_path, "failed", error)
+
+    def summary(self) -> Dict[str, Any]:
+        if self._final_summary is not None:
+            return self._final_summary
+        with self._lock:
+            counts = dict(
+                self._connection.execute(
+                    "SELECT state, COUNT(*) FROM items GROUP BY state"
+                ).fetchall()
+            )
+            return {
+                "pending": counts.get("pending", 0),
+                "leased": counts.get("leased", 0),
+                "done": counts.get("done", 0),
+                "failed": counts.get("failed", 0),
+                "claimed": self.claimed,
+                "recovered": self.recovered,
+                "completed": self.completed,
+                "failed_here": self.failed,
+                "lost": self.lost,
+            }
+
+    def close(self) -> None:
+        """Stop renewing leases and hand back every item this worker did not finish."""
+        self._stop.set()
+        self._heartbeat.join()
+        with self._lock:
+            self._connection.execute(
+                "UPDATE items SET state = 'pending', owner = NULL, lease_until = NULL "
+                "WHERE state = 'leased' AND owner = ?",
+                (self.worker,),
+            )
+        self._final_summary = self.summary()
+        self._connection.close()
+
+    def _insert(self, rows: List[tuple]) -> None:
+        if not rows:
+            return
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO items (path, seq, state) VALUES (?, ?, ?)", rows
+            )
+            self._connection.execute("COMMIT")
+
+    def _finish(self, rel_path: str, state: str, error: Optional[str]) -> bool:
+        with self._lock:
+            cursor = self._connection.execute(
+                "UPDATE items SET state = ?, error = ?, lease_until = NULL "
+                "WHERE path = ? AND state = 'leased' AND owner = ?",
+                (state, error, rel_path, self.worker),
+            )
+            if cursor.rowcount == 0:
+                self.lost += 1
+            elif state == "done":
+                self.completed += 1
+            else:
+                self.failed += 1
+        if cursor.rowcount == 0:
+            warn(f"Lease on {rel_path} was lost before it finished; another worker owns it.")
+        return cursor.rowcount > 0
+
+    def _renew_leases(self) -> None:
+        while not self._stop.wait(self.lease_seconds / 3):
+            with self._lock:
+                self._connection.execute(
+                    "UPDATE items SET lease_until = ? WHERE state = 'leased' AND owner = ?",
+                    (time.time() + self.lease_seconds, self.worker),
+                )